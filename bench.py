@@ -0,0 +1,393 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Offline benchmark for rip.py. Runs a local stand-in for ncode.syosetu.com, api.syosetu.com and the yomou ranking page,
+# points a copy of rip.py at it through http_proxy, and reports how fast it went and where the time went.
+# Nothing here talks to the real site, so it's safe to use while changing the scheduler, the rate limiting, or the parser.
+#
+# usage: python bench.py [scenario ...] [setting=value ...] [--json report.json]
+# scenarios are listed in the scenarios dict below (default: small). setting=value overrides a setting in settings.py
+# for the run, e.g. python bench.py ratelimited chapters_per_second=20 limit_connections=4
+# the fake server's own options can be overridden the same way with server.option=value, e.g. server.latency=0.2
+
+import asyncio
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from aiohttp import web
+
+# Fake server options. Every scenario starts from these.
+server_defaults = {
+    # seconds added to every response, plus or minus up to jitter seconds
+    "latency": 0.02,
+    "jitter": 0.01,
+    # fraction of chapter and index requests that get a 503
+    "error_rate": 0.0,
+    # fraction of chapter and index requests that get narou's "Too many access!" page (with a 200)
+    "toomany_rate": 0.0,
+    # requests per second the server lets through before rate limiting (0 for no limit), and how it says so ("503" or "toomany")
+    "requests_per_second": 0,
+    "ratelimit_response": "503",
+    # size of the synthetic site
+    "stories": 10,
+    "chapters": 20,
+    # lines of text per chapter
+    "lines": 60,
+    # for update runs: fraction of stories that change, how many chapters each gets, and how many old chapters get edited
+    "update_fraction": 0.3,
+    "new_chapters": 2,
+    "edited_chapters": 1,
+    # makes the synthetic text and the random errors repeatable
+    "seed": 1,
+}
+
+# Each scenario is a set of server options, setting overrides (see settings.py), and the steps to run.
+# A step is either a list of arguments for rip.py, or "advance" to make the site change (new and edited chapters) like it would between update runs.
+scenarios = {
+    "small": {
+        "server": {"stories": 10, "chapters": 20},
+        "settings": {"chapters_per_second": "1000", "max_chapters_per_second": "1000", "token_bucket_size": "100"},
+        "steps": [["--yomou"]],
+    },
+    "large": {
+        "server": {"stories": 100, "chapters": 100, "latency": 0.05, "jitter": 0.03},
+        "settings": {"chapters_per_second": "1000", "max_chapters_per_second": "1000", "token_bucket_size": "100"},
+        "steps": [["--yomou"]],
+    },
+    # default pacing against a server that rate limits, to see how close the adaptive rate limit gets to what the server allows
+    "ratelimited": {
+        "server": {"stories": 10, "chapters": 30, "requests_per_second": 15, "ratelimit_response": "toomany", "error_rate": 0.01},
+        "settings": {"wait_if_ratelimited": "1", "max_wait_if_ratelimited": "5"},
+        "steps": [["--yomou"]],
+    },
+    # a full rip, then an --updateknown after some stories changed
+    "update": {
+        "server": {"stories": 50, "chapters": 30},
+        "settings": {"chapters_per_second": "1000", "max_chapters_per_second": "1000", "token_bucket_size": "100"},
+        "steps": [["--yomou"], "advance", ["--updateknown"], ["--updateknown"]],
+    },
+}
+
+story_started = 1577836800 # 2020-01-01
+
+kana = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+kanji = "日月火水木金土山川田人口目耳手足力空天気雨電車学校先生"
+punctuation = "、。「」"
+
+class FakeSite:
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options["seed"])
+        self.counts = {}
+        self.stories = []
+        for i in range(options["stories"]):
+            ncode = f"n{1000 + i}bm"
+            updated = time.time() - 86400 * 30
+            # chapter number -> (posted, revised or None, version)
+            chapters = {}
+            for chapter in range(1, options["chapters"] + 1):
+                chapters[chapter] = (story_started + chapter * 86400, None, 0)
+            self.stories += [{"ncode": ncode, "title": f"ベンチマーク作品{i}", "updated": updated, "chapters": chapters}]
+        self.by_ncode = {story["ncode"]: story for story in self.stories}
+        self.tokens = options["requests_per_second"]
+        self.last_refill = time.monotonic()
+    
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+    
+    # new chapters and edits for some of the stories, like the site would see between two update runs
+    def advance(self):
+        now = time.time()
+        changed = self.random.sample(self.stories, max(1, int(len(self.stories) * self.options["update_fraction"])))
+        for story in changed:
+            chapters = story["chapters"]
+            for chapter in self.random.sample(sorted(chapters), min(len(chapters), self.options["edited_chapters"])):
+                (posted, revised, version) = chapters[chapter]
+                chapters[chapter] = (posted, int(now), version + 1)
+            for n in range(self.options["new_chapters"]):
+                chapters[len(chapters) + 1] = (int(now), None, 0)
+            story["updated"] = now
+        return len(changed)
+    
+    def ratelimited(self):
+        rate = self.options["requests_per_second"]
+        if rate > 0:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.last_refill) * rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return self.options["ratelimit_response"]
+            self.tokens -= 1
+        roll = self.random.random()
+        if roll < self.options["error_rate"]:
+            return "503"
+        if roll < self.options["error_rate"] + self.options["toomany_rate"]:
+            return "toomany"
+        return None
+    
+    def ratelimit_page(self, kind):
+        if kind == "toomany":
+            self.count("toomany")
+            return web.Response(text="<html><body>Too many access!</body></html>", content_type="text/html")
+        self.count("503")
+        return web.Response(status=503, text="Service Unavailable")
+    
+    def chapter_text(self, ncode, chapter, version):
+        # seeded per chapter so the text doesn't depend on the order chapters are requested in
+        rng = random.Random(f"{self.options['seed']}-{ncode}-{chapter}-{version}")
+        lines = []
+        for n in range(self.options["lines"]):
+            if rng.random() < 0.1:
+                lines += ["<br />"]
+                continue
+            line = "　"
+            for word in range(rng.randint(3, 12)):
+                if rng.random() < 0.05:
+                    line += f"<ruby>{rng.choice(kanji)}{rng.choice(kanji)}<rp>(</rp><rt>{''.join(rng.choice(kana) for k in range(3))}</rt><rp>)</rp></ruby>"
+                elif rng.random() < 0.3:
+                    line += "".join(rng.choice(kanji) for k in range(rng.randint(1, 3)))
+                else:
+                    line += "".join(rng.choice(kana) for k in range(rng.randint(2, 6)))
+                line += rng.choice(punctuation)
+            lines += [line]
+        return lines
+    
+    def index_page(self, story):
+        rows = ""
+        for (chapter, (posted, revised, version)) in sorted(story["chapters"].items()):
+            if chapter % 10 == 1:
+                rows += f'<div class="chapter_title">第{chapter // 10 + 1}章</div>\n'
+            revision = ""
+            if revised != None:
+                revision = f'<span title="{time.strftime("%Y/%m/%d %H:%M", time.localtime(revised))} 改稿">（<u>改</u>）</span>'
+            rows += f'<dl class="novel_sublist2">\n<dd class="subtitle">\n<a href="/{story["ncode"]}/{chapter}/">第{chapter}話</a>\n</dd>\n<dt class="long_update">\n{time.strftime("%Y/%m/%d %H:%M", time.localtime(posted))}{revision}</dt>\n</dl>\n'
+        return f'<!DOCTYPE html>\n<html><head><meta charset="UTF-8"><title>{story["title"]}</title></head><body>\n<div id="novel_color">\n<p class="novel_title">{story["title"]}</p>\n<div class="index_box">\n{rows}</div>\n</div>\n</body></html>'
+    
+    def chapter_page(self, story, chapter):
+        (posted, revised, version) = story["chapters"][chapter]
+        lines = self.chapter_text(story["ncode"], chapter, version)
+        body = "".join(f'<p id="L{n + 1}">{line}</p>\n' for (n, line) in enumerate(lines))
+        return f'<!DOCTYPE html>\n<html><head><meta charset="UTF-8"><title>第{chapter}話</title></head><body>\n<div id="novel_color">\n<p class="novel_subtitle">第{chapter}話</p>\n<div id="novel_p" class="novel_view">\n<p id="Lp1">前書き</p>\n</div>\n<div id="novel_honbun" class="novel_view">\n{body}</div>\n</div>\n</body></html>'
+    
+    def ranking_page(self):
+        items = ""
+        for (rank, story) in enumerate(self.stories[:300]):
+            items += f'<div class="rank_h"><p class="ranking_number">{rank + 1}位</p><a href="http://ncode.syosetu.com/{story["ncode"]}/">{story["title"]}</a></div>\n'
+        return f'<html><body><div class="ranking_list">\n{items}</div></body></html>'
+    
+    def novelapi_info(self, story):
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(story["updated"]))
+        chapters = story["chapters"]
+        return {"ncode": story["ncode"].upper(), "title": story["title"], "writer": "ベンチ", "story": f"{story['title']}のあらすじ",
+            "general_all_no": len(chapters), "length": len(chapters) * self.options["lines"] * 40, "end": 1, "novel_type": 1,
+            "general_firstup": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(story_started)), "general_lastup": updated,
+            "novelupdated_at": updated, "updated_at": updated}
+    
+    def novelapi(self, query):
+        if "ncode" in query:
+            stories = [self.by_ncode[ncode] for ncode in query["ncode"].lower().split("-") if ncode in self.by_ncode]
+        else:
+            stories = self.stories
+        if "lastupdate" in query:
+            (start, end) = [int(n) for n in query["lastupdate"].split("-")]
+            stories = [story for story in stories if start <= story["updated"] <= end]
+            if query.get("order") == "old":
+                stories = sorted(stories, key=lambda story: story["updated"])
+        start = int(query.get("st", 1))
+        limit = int(query.get("lim", 20))
+        data = json.dumps([{"allcount": len(stories)}] + [self.novelapi_info(story) for story in stories[start - 1:start - 1 + limit]], ensure_ascii=False).encode("utf-8")
+        if "gzip" in query:
+            return web.Response(body=gzip.compress(data), content_type="application/x-gzip")
+        return web.Response(body=data, content_type="application/json")
+    
+    async def handle(self, request):
+        delay = self.options["latency"] + self.random.uniform(-self.options["jitter"], self.options["jitter"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        host = request.host.split(":")[0]
+        path = request.path
+        if host == "api.syosetu.com":
+            self.count("novelapi")
+            return self.novelapi(request.query)
+        if host == "yomou.syosetu.com":
+            self.count("ranking")
+            return web.Response(text=self.ranking_page(), content_type="text/html")
+        
+        parts = path.strip("/").split("/")
+        story = self.by_ncode.get(parts[0].lower())
+        if story == None or len(parts) > 2:
+            self.count("404")
+            return web.Response(status=404)
+        
+        limited = self.ratelimited()
+        if limited != None:
+            return self.ratelimit_page(limited)
+        
+        if len(parts) == 1:
+            self.count("index")
+            page = self.index_page(story)
+            etag = f'"{zlib.crc32(page.encode("utf-8")):08x}"'
+            if request.headers.get("If-None-Match") == etag:
+                self.count("index_304")
+                return web.Response(status=304, headers={"ETag": etag})
+            return web.Response(text=page, content_type="text/html", headers={"ETag": etag})
+        
+        chapter = int(parts[1])
+        if chapter not in story["chapters"]:
+            self.count("404")
+            return web.Response(status=404)
+        self.count("chapter")
+        return web.Response(text=self.chapter_page(story, chapter), content_type="text/html")
+
+async def start_server(site):
+    app = web.Application()
+    app.router.add_route("GET", "/{path:.*}", site.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    server = web.TCPSite(runner, "127.0.0.1", 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    return (runner, port)
+
+# Copies rip.py and the modules it imports into directory, with the given settings changed.
+def prepare_rip(directory, settings):
+    # the benchmark's rates would otherwise end up in the rate every other rip.py on this computer shares
+    settings = dict({"shared_ratelimit_path": repr(os.path.join(directory, "ratelimit.db"))}, **settings)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in os.listdir(here):
+        if name.endswith(".py") and name != "bench.py":
+            shutil.copy(os.path.join(here, name), directory)
+    with open(os.path.join(directory, "settings.py"), encoding="utf-8") as f:
+        source = f.read()
+    for (name, value) in settings.items():
+        (source, found) = re.subn(f"^{re.escape(name)} = .*$", lambda match: f"{name} = {value}", source, count=1, flags=re.M)
+        if found == 0:
+            print(f"settings.py has no setting called {name}")
+            exit(1)
+    with open(os.path.join(directory, "settings.py"), "w", encoding="utf-8") as f:
+        f.write(source)
+
+async def run_step(directory, port, arguments, log):
+    report_path = os.path.join(directory, "metrics.json")
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    env = dict(os.environ)
+    for name in ["no_proxy", "NO_PROXY", "https_proxy", "HTTPS_PROXY"]:
+        env.pop(name, None)
+    env["http_proxy"] = f"http://127.0.0.1:{port}"
+    env["HTTP_PROXY"] = env["http_proxy"]
+    
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, "rip.py", *arguments, cwd=directory, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT)
+    code = await process.wait()
+    wall = time.perf_counter() - start
+    
+    if code != 0 or not os.path.exists(report_path):
+        return {"arguments": arguments, "wall": wall, "failed": code}
+    with open(report_path, encoding="utf-8") as f:
+        report = json.load(f)
+    report["arguments"] = arguments
+    report["wall"] = wall
+    return report
+
+async def run_scenario(name, scenario, setting_overrides, server_overrides):
+    options = dict(server_defaults)
+    options.update(scenario["server"])
+    options.update(server_overrides)
+    # rip.py's own metrics report is what most of the numbers come from
+    settings = {"metrics_report": '"metrics.json"'}
+    settings.update(scenario["settings"])
+    settings.update(setting_overrides)
+    
+    site = FakeSite(options)
+    (runner, port) = await start_server(site)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="narourip-bench-") as directory:
+        prepare_rip(directory, settings)
+        with open(os.path.join(directory, "rip.log"), "w", encoding="utf-8") as log:
+            for step in scenario["steps"]:
+                if step == "advance":
+                    print(f"{name}: {site.advance()} stories changed")
+                    continue
+                print(f"{name}: running rip.py {' '.join(step)}")
+                before = dict(site.counts)
+                result = await run_step(directory, port, step, log)
+                result["server"] = {key: site.counts.get(key, 0) - before.get(key, 0) for key in site.counts}
+                result["database_bytes"] = sum(os.path.getsize(os.path.join(directory, file)) for file in os.listdir(directory) if file.startswith("naroudb.db"))
+                results += [result]
+                if "failed" in result:
+                    print(f"{name}: rip.py {' '.join(step)} failed (exit code {result['failed']}). its output:")
+                    log.flush()
+                    with open(os.path.join(directory, "rip.log"), encoding="utf-8") as f:
+                        print(f.read()[-4000:])
+                    break
+    await runner.cleanup()
+    return {"scenario": name, "server_options": options, "settings": settings, "steps": results}
+
+def print_report(report):
+    print()
+    print(f"== {report['scenario']} ({report['server_options']['stories']} stories, {report['server_options']['chapters']} chapters each)")
+    for step in report["steps"]:
+        print(f"rip.py {' '.join(step['arguments'])}")
+        if "failed" in step:
+            print(f"  failed after {step['wall']:.2f}s")
+            continue
+        def counter(name):
+            return sum(entry["value"] for entry in step["counters"].get(name, []))
+        chapters = counter("chapters")
+        phases = step["phases"]
+        print(f"  {step['wall']:.2f}s wall, {chapters} chapters, {chapters / step['total'] if step['total'] > 0 else 0:.1f} chapters/sec")
+        if chapters > 0 and "db_write" in phases:
+            print(f"  database writes: {phases['db_write']['seconds'] * 1000 / chapters:.2f}ms per chapter, database is {step['database_bytes'] / 1024 / 1024:.1f}MiB")
+        print(f"  requests sent: {counter('requests')} over {counter('connections_opened')} connections, {counter('bytes') / 1024 / 1024:.1f}MiB received, {counter('retries')} retries, ratelimited {counter('ratelimits')} times")
+        for entry in step["histograms"].get("request_seconds", []):
+            print(f"  {entry['labels']['kind']} latency: p50 <= {entry['p50']}s, p90 <= {entry['p90']}s, p99 <= {entry['p99']}s")
+        print(f"  server saw: {', '.join(f'{key} {value}' for (key, value) in sorted(step['server'].items()) if value > 0)}")
+        print("  time per phase (phases that run at the same time overlap):")
+        for (phase, entry) in sorted(phases.items(), key=lambda item: -item[1]["seconds"]):
+            print(f"    {phase:<15} {entry['seconds']:8.3f}s  {entry['count']:6} times")
+
+if __name__ == "__main__":
+    names = []
+    setting_overrides = {}
+    server_overrides = {}
+    json_path = None
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == "--json":
+            json_path = args.pop(0)
+        elif arg.startswith("server."):
+            (key, value) = arg[len("server."):].split("=", 1)
+            if key not in server_defaults:
+                print(f"the server has no option called {key}")
+                exit(1)
+            server_overrides[key] = type(server_defaults[key])(value)
+        elif "=" in arg:
+            (key, value) = arg.split("=", 1)
+            setting_overrides[key] = value
+        elif arg in scenarios:
+            names += [arg]
+        else:
+            print(f"unknown scenario {arg}. scenarios: {', '.join(scenarios)}")
+            exit(1)
+    if names == []:
+        names = ["small"]
+    
+    reports = []
+    for name in names:
+        reports += [asyncio.run(run_scenario(name, scenarios[name], setting_overrides, server_overrides))]
+    for report in reports:
+        print_report(report)
+    if json_path != None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=1, ensure_ascii=False)
@@ -0,0 +1,95 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Compression for stored chapter content and text.
+# Stored values are either plain strings (uncompressed, like everything stored before compression existed)
+# or bytes starting with a short marker that says how they were compressed.
+
+import difflib
+import json
+import zlib
+
+# optional; only needed for content_compression = "zstd"
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_MARKER = b"NRz1"
+ZSTD_MARKER = b"NRs1" # followed by the 4-byte id of the dictionary it was compressed with (0 for none)
+
+# keyed by the dictionary itself and not just its id: every database numbers its dictionaries from 1, and several can be open at once (e.g. --merge)
+_compressors = {}
+_decompressors = {}
+
+# dictionary is (id, bytes) or None. only used by zstd.
+def encode(text, method, dictionary=None):
+    if text == None or method == "none":
+        return text
+    data = text.encode("utf-8")
+    if method == "zlib":
+        return ZLIB_MARKER + zlib.compress(data, 9)
+    if method == "zstd":
+        (dict_id, dict_data) = (0, None) if dictionary == None else dictionary
+        if dict_data not in _compressors:
+            if dictionary == None:
+                _compressors[dict_data] = zstandard.ZstdCompressor(level=12)
+            else:
+                _compressors[dict_data] = zstandard.ZstdCompressor(level=12, dict_data=zstandard.ZstdCompressionDict(dict_data))
+        return ZSTD_MARKER + dict_id.to_bytes(4, "little") + _compressors[dict_data].compress(data)
+    raise ValueError(f"unknown compression method {method}")
+
+# dictionaries maps dictionary ids to their bytes
+def decode(value, dictionaries):
+    if not isinstance(value, bytes):
+        return value
+    if value.startswith(ZLIB_MARKER):
+        return zlib.decompress(value[len(ZLIB_MARKER):]).decode("utf-8")
+    if value.startswith(ZSTD_MARKER):
+        start = len(ZSTD_MARKER)
+        dict_id = int.from_bytes(value[start:start+4], "little")
+        dict_data = None if dict_id == 0 else dictionaries[dict_id]
+        if dict_data not in _decompressors:
+            if zstandard == None:
+                raise RuntimeError("this database has chapters compressed with zstd. install the zstandard module to read them")
+            if dict_data == None:
+                _decompressors[dict_data] = zstandard.ZstdDecompressor()
+            else:
+                _decompressors[dict_data] = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dict_data))
+        return _decompressors[dict_data].decompress(value[start+4:]).decode("utf-8")
+    return value.decode("utf-8")
+
+def encode_pair(pair, method, dictionary=None):
+    return (encode(pair[0], method, dictionary), encode(pair[1], method, dictionary))
+
+# samples is a list of strings (whole chapters). the dictionary captures markup and phrasing they have in common.
+def train_dictionary(samples, size):
+    return zstandard.train_dictionary(size, [sample.encode("utf-8") for sample in samples]).as_bytes()
+
+# Earlier versions of edited chapters are stored as deltas: what has to be done to the newer version (line by line) to get the older one back.
+# A delta is a list of [start, end] (copy those lines of the newer version) and strings (text that only the older version has).
+def make_delta(newer, older):
+    newer_lines = newer.splitlines(keepends=True)
+    older_lines = older.splitlines(keepends=True)
+    delta = []
+    for (tag, i1, i2, j1, j2) in difflib.SequenceMatcher(None, newer_lines, older_lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            delta += [[i1, i2]]
+        elif j2 > j1:
+            delta += ["".join(older_lines[j1:j2])]
+    return json.dumps(delta, ensure_ascii=False)
+
+def apply_delta(newer, delta):
+    newer_lines = newer.splitlines(keepends=True)
+    older = []
+    for entry in json.loads(delta):
+        if isinstance(entry, str):
+            older += [entry]
+        else:
+            older += newer_lines[entry[0]:entry[1]]
+    return "".join(older)
+
+# pair is (newer, older). Returns the delta, compressed.
+def encode_delta(pair, method, dictionary=None):
+    return encode(make_delta(pair[0], pair[1]), method, dictionary)
@@ -0,0 +1,453 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Writes stories out of the database into files.
+# dump_story runs in the parse worker processes (see parsepool.py), so it opens its own connection to the database instead of sharing the Store's.
+
+import sqlite3
+import os
+import io
+import re
+import html
+import time
+import shutil
+import urllib.parse
+import zipfile
+import codec
+
+connections = {}
+
+def get_connection(database_path):
+    if database_path not in connections:
+        database = sqlite3.connect(database_path)
+        dictionaries = dict(database.execute("SELECT id, data from compression_dicts").fetchall())
+        connections[database_path] = (database, dictionaries)
+    return connections[database_path]
+
+# Writes to a temporary file next to path, which replaces path once it's complete, so an interrupted dump never leaves a half-written file behind.
+class AtomicWriter:
+    def __init__(self, path, newline=None):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.newline = newline
+    def __enter__(self):
+        self.file = open(self.temp_path, "w", encoding='utf-8', newline=self.newline)
+        return self.file
+    def __exit__(self, kind, value, traceback):
+        self.file.close()
+        if kind == None:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+
+# job is (database path, ncode, path to write to). Chapters go straight from the database to the file, one at a time.
+def dump_story(job):
+    (database_path, ncode, path) = job
+    (database, dictionaries) = get_connection(database_path)
+    with AtomicWriter(path, newline='\n') as f:
+        for (text,) in database.execute("SELECT text from chapters where ncode=? order by chapter", (ncode,)):
+            f.write(codec.decode(text, dictionaries))
+            f.write("\n\n\n")
+    return ncode
+
+# Builds an EPUB 3 file one page at a time, straight into the zip file, so memory use doesn't depend on the length of the story.
+# The navigation document and package document (manifest, spine) only list files, so they're written last.
+class EpubWriter:
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.zip = zipfile.ZipFile(self.temp_path, "w", zipfile.ZIP_DEFLATED)
+        # has to be the first file in the zip, and uncompressed
+        self.zip.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr("META-INF/container.xml", epub_container)
+        self.manifest = [] # id, href, media type, properties
+        self.spine = []
+        self.finished = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, kind, value, traceback):
+        if not self.finished:
+            self.zip.close()
+            os.remove(self.temp_path)
+    
+    def add_file(self, href, data, media_type):
+        self.zip.writestr(f"OEBPS/{href}", data)
+        self.manifest += [(f"file{len(self.manifest)}", href, media_type, None)]
+    
+    # Returns a text file to write the page's body into. Close it when the page is done.
+    def open_page(self, href, title, stylesheet="narourip.css"):
+        page = EpubPage(io.TextIOWrapper(self.zip.open(f"OEBPS/{href}", "w"), encoding="utf-8"))
+        page.file.write(xhtml_header(title, stylesheet))
+        item_id = f"page{len(self.spine)}"
+        self.manifest += [(item_id, href, "application/xhtml+xml", None)]
+        self.spine += [item_id]
+        return page
+    
+    # nav is [(volume title or None, [(chapter title, href), ...]), ...]
+    def finish(self, identifier, title, creator, description, nav, stylesheet="narourip.css"):
+        document = xhtml_header(title, stylesheet, 'xmlns:epub="http://www.idpf.org/2007/ops"')
+        document += f'<nav epub:type="toc" id="toc">\n<h1>{escape(title)}</h1>\n<ol>\n'
+        for (volume_title, chapters) in nav:
+            items = "".join(f'<li><a href="{escape(href)}">{escape(chapter_title)}</a></li>\n' for (chapter_title, href) in chapters)
+            if volume_title == None:
+                document += items
+            else:
+                document += f'<li><a href="{escape(chapters[0][1])}">{escape(volume_title)}</a>\n<ol>\n{items}</ol>\n</li>\n'
+        document += '</ol>\n</nav>\n' + xhtml_footer
+        self.zip.writestr("OEBPS/nav.xhtml", document)
+        self.manifest += [("nav", "nav.xhtml", "application/xhtml+xml", "nav")]
+        
+        package = '<?xml version="1.0" encoding="utf-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="ja">\n'
+        package += '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+        package += f'<dc:identifier id="bookid">{escape(identifier)}</dc:identifier>\n'
+        package += f'<dc:title>{escape(title)}</dc:title>\n'
+        if creator != None:
+            package += f'<dc:creator>{escape(creator)}</dc:creator>\n'
+        package += '<dc:language>ja</dc:language>\n'
+        if description != None:
+            package += f'<dc:description>{escape(description)}</dc:description>\n'
+        package += f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>\n'
+        package += '</metadata>\n<manifest>\n'
+        for (item_id, href, media_type, properties) in self.manifest:
+            properties = "" if properties == None else f' properties="{properties}"'
+            package += f'<item id="{item_id}" href="{escape(href)}" media-type="{media_type}"{properties}/>\n'
+        package += '</manifest>\n<spine>\n'
+        for item_id in self.spine:
+            package += f'<itemref idref="{item_id}"/>\n'
+        package += '</spine>\n</package>\n'
+        self.zip.writestr("OEBPS/content.opf", package)
+        
+        self.zip.close()
+        os.replace(self.temp_path, self.path)
+        self.finished = True
+
+class EpubPage:
+    def __init__(self, file):
+        self.file = file
+    def __enter__(self):
+        return self.file
+    def __exit__(self, kind, value, traceback):
+        self.file.write(xhtml_footer)
+        self.file.close()
+
+def escape(text):
+    return html.escape(text, quote=True)
+
+def xhtml_header(title, stylesheet, namespaces=""):
+    if namespaces != "":
+        namespaces = " " + namespaces
+    return f'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n<html xmlns="http://www.w3.org/1999/xhtml"{namespaces} lang="ja" xml:lang="ja">\n<head>\n<title>{escape(title)}</title>\n<link rel="stylesheet" type="text/css" href="{stylesheet}"/>\n</head>\n<body>\n'
+
+xhtml_footer = "</body>\n</html>\n"
+
+epub_container = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+# Exports of stories from a Store (see store.py). The html exports only write files whose contents would come out different from last time.
+
+html_header = """<!doctype html>
+<html lang="ja">
+<head>
+<title>TITLE</title>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<link rel="stylesheet" href="narourip.css">
+</head>
+<body>
+"""
+
+html_footer = """
+</body>
+</html>"""
+
+def sanitize_fs_name(text):
+    if text == None:
+        return ""
+    mapping = [
+      ('/', '／' ),
+      ('\\', '＼' ),
+      ('?', '？' ),
+      ('%', '％' ),
+      ('*', '＊' ),
+      (':', '：' ),
+      ('|', '｜' ),
+      ('"', '”' ),
+      ('<', '＜' ),
+      ('>', '＞' )
+    ]
+    for m in mapping:
+        text = text.replace(m[0], m[1])
+    return re.sub(' +', ' ', text)
+
+def html_escape(text):
+    if text == None:
+        return ""
+    return html.escape(text, quote=True)
+def url_escape(text):
+    if text == None:
+        return ""
+    return urllib.parse.quote(text)
+
+# very old databases have chapters stored as plain text instead of html
+def chapter_html(content):
+    if not content.startswith("<div"):
+        content = f"<div class=preformat>{content}</div>"
+    return content
+
+# EPUB readers don't load images from the internet (and epubcheck rejects books whose pages try), so illustrations become links to them,
+# labeled with their alt text. Images that are in the book themselves get an empty alt if they have none.
+def epub_images(content):
+    def replace(match):
+        tag = match[0]
+        src = re.search(r'\bsrc="([^"]*)"', tag)
+        alt = re.search(r'\balt="([^"]*)"', tag)
+        if src == None or not re.match("(https?:)?//", src[1]):
+            return tag if alt != None else tag.replace("<img", '<img alt=""', 1)
+        label = alt[1] if alt != None and alt[1] != "" else "挿絵"
+        # narou puts most of them inside a link to the image's page already
+        before = content[:match.start()]
+        if before.rfind("<a ") > before.rfind("</a>"):
+            return label
+        return f'<a href="{src[1]}">{label}</a>'
+    return re.sub(r"<img\b[^>]*>", replace, content)
+
+# One html file per volume, in a folder named after the story
+def export_html_volumes(store, ncode, stylesheet="data/narourip.css"):
+    noveltitle = store.title(ncode)
+    noveltitle_fs = sanitize_fs_name(noveltitle)
+    noveltitle = html_escape(noveltitle)
+    if not os.path.exists(noveltitle_fs):
+        os.mkdir(noveltitle_fs)
+    shutil.copyfile(stylesheet, f"{noveltitle_fs}/narourip.css")
+    summary = store.summary(ncode)
+    if summary == None:
+        summary = ""
+    volumes = []
+    if store.has_volumes(ncode):
+        volumes = store.get_story_layout(ncode)
+    
+    # work out which files need to be written before loading any chapter contents
+    pages = []
+    for (i, (vol_title, chapters)) in enumerate(volumes):
+        i += 1
+        
+        fs_vol_title = sanitize_fs_name(vol_title).strip()
+        if fs_vol_title != "":
+            fs_vol_title = " - " + fs_vol_title
+        
+        if len(volumes) > 1:
+            vol_num = f" - {i}"
+        else:
+            vol_num = ""
+        
+        fname = f"{noveltitle_fs}/{noveltitle_fs}{vol_num}{fs_vol_title}.html"
+        dependencies = [html_header, html_footer, noveltitle, summary, vol_title, chapters]
+        if not store.export_is_current(fname, dependencies):
+            pages += [(fname, vol_title, chapters, dependencies)]
+    
+    contents = store.stream_contents(ncode, [chapter[0] for page in pages for chapter in page[2]])
+    for (fname, vol_title, chapters, dependencies) in pages:
+        with AtomicWriter(fname) as f:
+            def write(text):
+                f.write(text.replace(""" src="//""", """ src="http://"""))
+            
+            write(html_header.replace("TITLE", html_escape(noveltitle)))
+            write(f"\n<h1>{html_escape(noveltitle)}</h1>")
+            if vol_title.strip() != "":
+                write(f"\n<h2>{html_escape(vol_title)}</h2>")
+            write(f"\n<p>{summary}</p>")
+            
+            write(f"\n<hr>")
+            
+            write("\n<div id=toc>")
+            for (chapter, chaptitle, hash) in chapters:
+                chaptitle = html_escape(chaptitle)
+                write(f"\n<div><a href=\"#{url_escape(chaptitle)}\">{html_escape(chaptitle)}</a></div>")
+            write("\n</div>")
+            
+            write(f"\n<hr>")
+            
+            for (chapter, chaptitle, hash) in chapters:
+                chaptitle = html_escape(chaptitle)
+                content = chapter_html(next(contents)[1])
+                write(f"\n<div id='{url_escape(chaptitle)}'><h3><a href=\"#{html_escape(chaptitle)}\">{html_escape(chaptitle)}</a></h3>{content}</div>")
+                write(f"\n<hr>")
+            
+            write(html_footer)
+        store.record_export(fname, ncode, dependencies)
+    
+    print(f"wrote {len(pages)} files ({len(volumes) - len(pages)} were already up to date)")
+
+# One html file per chapter, in a folder named after the story. numbered adds the chapter number to each file's name.
+def export_html_chapters(store, ncode, numbered=True, stylesheet="data/narourip.css"):
+    noveltitle = store.title(ncode)
+    noveltitle_fs = sanitize_fs_name(noveltitle)
+    noveltitle = html_escape(noveltitle)
+    if not os.path.exists(noveltitle_fs):
+        os.mkdir(noveltitle_fs)
+    shutil.copyfile(stylesheet, f"{noveltitle_fs}/narourip.css")
+    summary = store.summary(ncode)
+    if summary == None:
+        summary = ""
+    volumes = store.get_story_layout(ncode)
+    
+    # work out which files need to be written before loading any chapter contents
+    pages = []
+    total = 0
+    for (i, (vol_title, chapters)) in enumerate(volumes):
+        i += 1
+        
+        fs_vol_title = sanitize_fs_name(vol_title).strip()
+        if fs_vol_title != "":
+            fs_vol_title = " - " + fs_vol_title
+        
+        if len(volumes) > 1:
+            vol_num = f" - {i}"
+        else:
+            vol_num = ""
+        
+        def get_chapter_fname(j):
+            chaptitle = chapters[j][1]
+            
+            fs_chaptitle = sanitize_fs_name(chaptitle).strip()
+            if fs_chaptitle != "":
+                fs_chaptitle = " - " + fs_chaptitle
+            
+            if not numbered:
+                chap_num = ""
+            else:
+                chap_num = f" - {j+1}"
+            
+            return f"{noveltitle_fs}{vol_num}{fs_vol_title}{chap_num}{fs_chaptitle}.html"
+        
+        for (j, (chapter, chaptitle, hash)) in enumerate(chapters):
+            total += 1
+            
+            prev_ = None
+            if j > 0:
+                prev_ = chapters[j-1][1]
+                if prev_ == None:
+                    prev_ = str(j)
+                prev_ = (prev_, get_chapter_fname(j-1))
+            next_ = None
+            if j+1 < len(chapters):
+                next_ = chapters[j+1][1]
+                if next_ == None:
+                    next_ = str(j+2)
+                next_ = (next_, get_chapter_fname(j+1))
+            
+            fname = f"{noveltitle_fs}/{get_chapter_fname(j)}"
+            # a chapter's page also shows the titles of (and links to) the chapters next to it
+            dependencies = [html_header, html_footer, noveltitle, summary, vol_title, chaptitle, hash, prev_, next_]
+            if not store.export_is_current(fname, dependencies):
+                pages += [(fname, vol_title, chapter, chaptitle, prev_, next_, dependencies)]
+    
+    contents = store.stream_contents(ncode, [page[2] for page in pages])
+    for (fname, vol_title, chapter, chaptitle, prev_, next_, dependencies) in pages:
+        content = chapter_html(next(contents)[1])
+        with AtomicWriter(fname) as f:
+            def write(text):
+                f.write(text.replace(""" src="//""", """ src="http://"""))
+            
+            write(html_header.replace("TITLE", html_escape(noveltitle)))
+            
+            write(f"\n<h1>{html_escape(noveltitle)}</h1>")
+            if vol_title.strip() != "":
+                write(f"\n<h2>{html_escape(vol_title)}</h2>")
+            write(f"\n<p>{summary}</p>")
+            
+            write(f"\n<hr>")
+            
+            write(f"\n<div style='display: flex; justify-content: center; width: 100%'>")
+            if prev_ != None:
+                write(f"\n<div style='width: 30%; text-align: right'><a href='{url_escape(prev_[1])}'>← {prev_[0]}</a></div>")
+            else:
+                write(f"\n<div style='width: 30%'></div>")
+            write(f"\n<div style='width: 40%; text-align: center'>{html_escape(chaptitle)}</div>")
+            if next_ != None:
+                write(f"\n<div style='width: 30%; text-align: left'><a href='{url_escape(next_[1])}'>{next_[0]}→</a></div>")
+            else:
+                write(f"\n<div style='width: 30%'></div>")
+            write(f"\n</div>")
+            
+            write(f"\n<hr>")
+            
+            write(f"\n<div id='{url_escape(chaptitle)}'><h3>{html_escape(chaptitle)}</h3>{content}</div>")
+            
+            write(html_footer)
+        store.record_export(fname, ncode, dependencies)
+    
+    print(f"wrote {len(pages)} files ({total - len(pages)} were already up to date)")
+
+# An epub file named after the story
+def export_epub(store, ncode, stylesheet="data/narourip.css"):
+    noveltitle = store.title(ncode)
+    summary = store.summary(ncode)
+    writer = store.writer(ncode)
+    volumes = [(vol_title, chapters) for (vol_title, chapters) in store.get_story_layout(ncode) if len(chapters) > 0]
+    
+    fname = f"{sanitize_fs_name(noveltitle)}.epub"
+    with EpubWriter(fname) as epub:
+        with open(stylesheet, "rb") as f:
+            epub.add_file("narourip.css", f.read(), "text/css")
+        
+        with epub.open_page("title.xhtml", noveltitle) as f:
+            f.write(f"<h1>{html_escape(noveltitle)}</h1>\n")
+            if writer != None:
+                f.write(f"<p>{html_escape(writer)}</p>\n")
+            if summary != None:
+                f.write(f"<p>{html_escape(summary).replace(chr(10), '<br/>')}</p>\n")
+        
+        nav = []
+        contents = store.stream_contents(ncode, [chapter[0] for (vol_title, chapters) in volumes for chapter in chapters])
+        for (i, (vol_title, chapters)) in enumerate(volumes):
+            entries = []
+            for (j, (chapter, chaptitle, hash)) in enumerate(chapters):
+                content = next(contents)[1]
+                if content.startswith("<div"):
+                    content = epub_images(content.replace(""" src="//""", """ src="http://""").replace(""" href="//""", """ href="http://"""))
+                else:
+                    content = f"<div class=\"preformat\">{html_escape(content)}</div>"
+                href = f"chapter{chapter}.xhtml"
+                with epub.open_page(href, chaptitle or str(chapter)) as f:
+                    if j == 0 and vol_title.strip() != "":
+                        f.write(f"<h2>{html_escape(vol_title)}</h2>\n")
+                    f.write(f"<h3>{html_escape(chaptitle)}</h3>\n")
+                    f.write(content)
+                    f.write("\n")
+                entries += [(chaptitle or str(chapter), href)]
+            nav += [(vol_title if vol_title.strip() != "" else None, entries)]
+        
+        epub.finish(f"https://ncode.syosetu.com/{ncode}/", noveltitle, writer, summary, nav)
+    print(f"wrote {fname}")
+
+# Every story as plain text, to e.g. scripts/n1701bm.txt
+def dump_all(store):
+    ncodes = store.known_ncodes()
+    target = len(ncodes)
+    jobs = []
+    fingerprints = {}
+    for ncode in ncodes:
+        writepath = f"scripts/{ncode}.txt"
+        # the manifest remembers what each file was written from, so only stories with new or changed chapters get written again
+        fingerprints[ncode] = store.story_fingerprint(ncode)
+        if os.path.exists(writepath) and store.c.execute("SELECT hash, chapters from dump_manifest where ncode=? and path=?", (ncode, writepath)).fetchone() == fingerprints[ncode]:
+            continue
+        jobs += [(store.path, ncode, writepath)]
+    if len(jobs) < target:
+        print(f"skipping {target - len(jobs)} stories that haven't changed since they were last dumped")
+    done = 0
+    for ncode in store.parse_pool.map(dump_story, jobs):
+        (fingerprint, chapters) = fingerprints[ncode]
+        store.c.execute("INSERT or replace into dump_manifest values (?,?,?,?,?)", (ncode, f"scripts/{ncode}.txt", fingerprint, chapters, int(time.time())))
+        store.commit()
+        done += 1
+        print(f"{done}/{len(jobs)} ({ncode})")
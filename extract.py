@@ -0,0 +1,516 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Pulls the parts of narou's pages that rip.py needs (the .novel_view blocks of chapter pages, and the title and chapter list of index pages)
+# out of the raw HTML in one streaming pass, without building a whole BeautifulSoup tree.
+
+# The output is byte-for-byte what the old BeautifulSoup code produced (BeautifulSoup(html, "html.parser").select(".novel_view") etc.),
+# so that nothing already stored in the database changes. To do that, this follows the exact same html.parser events that BeautifulSoup does
+# and mimics how it builds and re-serializes its tree: attributes get sorted, multi-valued attributes get their whitespace normalized,
+# whitespace-only strings get collapsed, void elements come out as <br/>, and so on.
+
+# Running this file directly compares it against BeautifulSoup (with the old code's selectors) on the saved pages in data/extract_corpus,
+# or on the given pages or directories of them, and fails if anything differs. Run it after changing anything here:
+#     python extract.py [pages or directories]
+
+from html.parser import HTMLParser
+from html.entities import html5
+import re
+import hashlib
+
+void_elements = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr'}
+preserve_whitespace_elements = {'pre', 'textarea'}
+# strings inside these aren't "text" as far as get_text() is concerned
+string_container_elements = {'rt', 'rp', 'style', 'script', 'template'}
+# strings directly inside these don't get escaped
+cdata_elements = {'script', 'style'}
+multi_valued_attributes = {
+    '*': {'class', 'accesskey', 'dropzone'},
+    'a': {'rel', 'rev'},
+    'link': {'rel', 'rev'},
+    'td': {'headers'},
+    'th': {'headers'},
+    'form': {'accept-charset'},
+    'object': {'archive'},
+    'area': {'rel'},
+    'icon': {'sizes'},
+    'iframe': {'sandbox'},
+    'output': {'for'},
+}
+ascii_spaces = "\x20\x0a\x09\x0c\x0d"
+nonwhitespace_re = re.compile(r"\S+")
+escape_re = re.compile("([<>&])")
+escapes = {"<": "&lt;", ">": "&gt;", "&": "&amp;"}
+
+entity_to_character = {}
+for (name, character) in sorted(html5.items()):
+    name = name.rstrip(";")
+    if name not in entity_to_character:
+        entity_to_character[name] = character
+
+def escape(text):
+    return escape_re.sub(lambda m: escapes[m.group(1)], text)
+
+def quote_attribute(value):
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+def numeric_character(number):
+    if number == 0 or number > 0x10ffff or (number >= 0xd800 and number <= 0xdfff):
+        return "�"
+    if number >= 0x80 and number <= 0x9f:
+        try:
+            return bytes([number]).decode("cp1252")
+        except UnicodeDecodeError:
+            pass
+    return chr(number)
+
+class Element:
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.parent = parent
+        self.attrs = {}
+        for (key, value) in attrs:
+            if value == None:
+                value = ""
+            self.attrs[key] = value
+        self.classes = []
+        for (key, value) in self.attrs.items():
+            if key in multi_valued_attributes['*'] or key in multi_valued_attributes.get(name, ()):
+                value = nonwhitespace_re.findall(value)
+                if key == "class":
+                    self.classes = value
+                self.attrs[key] = " ".join(value)
+
+    def start_tag(self):
+        text = "<" + self.name
+        for key in sorted(self.attrs):
+            text += " " + key + "=" + quote_attribute(escape(self.attrs[key]))
+        if self.name in void_elements:
+            text += "/"
+        return text + ">"
+
+    def end_tag(self):
+        if self.name in void_elements:
+            return ""
+        return "</" + self.name + ">"
+
+# Replays html.parser's events the way BeautifulSoup's tree builder would, but instead of building a tree, calls
+# start(element), end(element) and string(text, kind, parent) as elements get opened and closed and strings get finished.
+# kind is "text" for normal text, "hidden" for strings that get_text() skips (e.g. furigana), or "comment", "cdata", "doctype", "declaration" or "pi".
+class TreeEvents(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.stack = []
+        self.data = []
+        self.preserving = 0
+        self.containers = 0
+        self.already_closed = []
+
+    def start(self, element):
+        pass
+    def end(self, element):
+        pass
+    def string(self, text, kind, parent):
+        pass
+
+    def parent(self):
+        if len(self.stack) == 0:
+            return None
+        return self.stack[-1]
+
+    def end_data(self, kind=None):
+        if len(self.data) == 0:
+            return
+        text = "".join(self.data)
+        self.data = []
+        if self.preserving == 0:
+            strippable = True
+            for char in text:
+                if char not in ascii_spaces:
+                    strippable = False
+                    break
+            if strippable:
+                if "\n" in text:
+                    text = "\n"
+                else:
+                    text = " "
+        if kind == None:
+            kind = "text"
+            if self.containers > 0:
+                kind = "hidden"
+        self.string(text, kind, self.parent())
+
+    def push(self, element):
+        self.stack.append(element)
+        if element.name in preserve_whitespace_elements:
+            self.preserving += 1
+        if element.name in string_container_elements:
+            self.containers += 1
+        self.start(element)
+
+    def pop(self):
+        element = self.stack.pop()
+        if element.name in preserve_whitespace_elements:
+            self.preserving -= 1
+        if element.name in string_container_elements:
+            self.containers -= 1
+        self.end(element)
+
+    def close_tag(self, name):
+        self.end_data()
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i].name == name:
+                while len(self.stack) > i:
+                    self.pop()
+                return
+
+    def handle_starttag(self, tag, attrs, void=True):
+        self.end_data()
+        self.push(Element(tag, attrs, self.parent()))
+        if void and tag in void_elements:
+            self.close_tag(tag)
+            self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, False)
+        self.close_tag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.already_closed:
+            self.already_closed.remove(tag)
+        else:
+            self.close_tag(tag)
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith("x") or name.startswith("X"):
+            self.data.append(numeric_character(int(name[1:], 16)))
+        else:
+            self.data.append(numeric_character(int(name)))
+
+    def handle_entityref(self, name):
+        self.data.append(entity_to_character.get(name, "&" + name))
+
+    def handle_special(self, data, kind):
+        self.end_data()
+        self.data.append(data)
+        self.end_data(kind)
+
+    def handle_comment(self, data):
+        self.handle_special(data, "comment")
+
+    def handle_decl(self, decl):
+        self.handle_special(decl[len("DOCTYPE "):], "doctype")
+
+    def unknown_decl(self, data):
+        if data.upper().startswith("CDATA["):
+            self.handle_special(data[len("CDATA["):], "cdata")
+        else:
+            self.handle_special(data, "declaration")
+
+    def handle_pi(self, data):
+        self.handle_special(data, "pi")
+
+    def finish(self):
+        self.close()
+        self.end_data()
+        while len(self.stack) > 0:
+            self.pop()
+
+def serialize_string(text, kind, parent):
+    if kind == "comment":
+        return "<!--" + text + "-->"
+    if kind == "cdata":
+        return "<![CDATA[" + text + "]]>"
+    if kind == "doctype":
+        return "<!DOCTYPE " + text + ">\n"
+    if kind == "declaration":
+        return "<?" + text + "?>"
+    if kind == "pi":
+        return "<?" + text + ">"
+    if parent != None and parent.name in cdata_elements:
+        return text
+    return escape(text)
+
+def is_text(kind):
+    return kind == "text" or kind == "cdata"
+
+def has_ancestor(element, test):
+    while element != None:
+        if test(element):
+            return True
+        element = element.parent
+    return False
+
+class NovelViewExtractor(TreeEvents):
+    def __init__(self):
+        TreeEvents.__init__(self)
+        self.results = []
+        # capturing elements and the output buffer for each; .novel_view elements can (in theory) be nested
+        self.capturing = []
+
+    def emit(self, text):
+        for (element, buffer) in self.capturing:
+            buffer.append(text)
+
+    def start(self, element):
+        if "novel_view" in element.classes:
+            buffer = []
+            self.results.append(buffer)
+            self.capturing.append((element, buffer))
+        if len(self.capturing) > 0:
+            self.emit(element.start_tag())
+
+    def end(self, element):
+        if len(self.capturing) > 0:
+            self.emit(element.end_tag())
+            if self.capturing[-1][0] is element:
+                self.capturing.pop()
+
+    def string(self, text, kind, parent):
+        if len(self.capturing) > 0:
+            self.emit(serialize_string(text, kind, parent))
+
+# Same as "".join(str(entry) for entry in BeautifulSoup(html, "html.parser").select(".novel_view"))
+def extract_novel_view(html):
+    parser = NovelViewExtractor()
+    parser.feed(html)
+    parser.finish()
+    return "".join("".join(buffer) for buffer in parser.results)
+
+class TextExtractor(TreeEvents):
+    def __init__(self):
+        TreeEvents.__init__(self)
+        self.texts = []
+
+    def string(self, text, kind, parent):
+        if is_text(kind):
+            self.texts.append(text)
+
+# Same as BeautifulSoup(html, "html.parser").get_text()
+def html_to_text(html):
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.finish()
+    return "".join(parser.texts)
+
+# Chapters are stored as the HTML of their .novel_view blocks (or, in very old databases, as plain text).
+def stored_to_text(content):
+    if content.startswith("<div"):
+        return html_to_text(content)
+    return content
+
+# Length in characters, ignoring newlines and leading/trailing whitespace on each line.
+def count_chars(text):
+    length = 0
+    for line in text.splitlines(False):
+        length += len(line.strip())
+    return length
+
+# Plain text and character count of a stored chapter, as kept in the text and charcount columns.
+def stored_text_and_count(content):
+    text = stored_to_text(content)
+    return (text, count_chars(text))
+
+# Identifies the content of a chapter, for telling whether it changed.
+def content_hash(content):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+# Everything that gets stored for a downloaded chapter page: (content, text, charcount, hash)
+def extract_chapter(html):
+    content = extract_novel_view(html)
+    return (content,) + stored_text_and_count(content) + (content_hash(content),)
+
+# For handing a whole list of pages to a worker process at once.
+def map_list(function, items):
+    return [function(item) for item in items]
+
+class IndexExtractor(TreeEvents):
+    def __init__(self):
+        TreeEvents.__init__(self)
+        self.title = None
+        self.rows = []
+        # elements whose get_text() we need, and the text collected for each so far
+        self.texts = {}
+        # the elements directly inside .index_box. there can be more than one open at once if .index_boxes are nested
+        self.entries = {}
+
+    def collect_text(self, element):
+        self.texts[id(element)] = []
+
+    def start(self, element):
+        parent = element.parent
+        if self.title == None and "novel_title" in element.classes and has_ancestor(parent, lambda x: x.attrs.get("id") == "novel_color"):
+            self.title = element
+            self.collect_text(element)
+        
+        ancestor = parent
+        while ancestor != None and len(self.entries) > 0:
+            entry = self.entries.get(id(ancestor))
+            ancestor = ancestor.parent
+            if entry == None:
+                continue
+            if entry["link"] == None and element.name == "a" and has_ancestor(parent, lambda x: "subtitle" in x.classes):
+                entry["link"] = element
+                self.collect_text(element)
+            if entry["long_update"] == None and "long_update" in element.classes:
+                entry["long_update"] = element
+                self.collect_text(element)
+            elif entry["long_update"] != None and entry["span"] == None and element.name == "span" and has_ancestor(parent, lambda x: x is entry["long_update"]):
+                entry["span"] = element
+        
+        if parent != None and "index_box" in parent.classes:
+            if element.name == "div":
+                self.rows.append(["volume", element])
+            else:
+                entry = {"link": None, "long_update": None, "span": None}
+                self.entries[id(element)] = entry
+                self.rows.append(["chapter", element, entry])
+            self.collect_text(element)
+
+    def string(self, text, kind, parent):
+        if not is_text(kind) or len(self.texts) == 0:
+            return
+        element = parent
+        while element != None:
+            if id(element) in self.texts:
+                self.texts[id(element)].append(text)
+            element = element.parent
+
+    def get_text(self, element):
+        if element == None or id(element) not in self.texts:
+            return None
+        return "".join(self.texts[id(element)])
+
+# Returns (title, rows) for an index page.
+# title is the .novel_title inside #novel_color, stripped, or None if there isn't one.
+# rows are the elements directly inside .index_box, in order, each one of:
+#   ["volume", name]
+#   ["chapter", url, chapter title, update time text, whether it's a .novel_sublist2]
+# The update time text is the title of the first span inside .long_update if there is one, or else the text of .long_update. It's None if there's no .long_update.
+def parse_index(html):
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", "replace")
+    parser = IndexExtractor()
+    parser.feed(html)
+    parser.finish()
+
+    title = parser.get_text(parser.title)
+    if title != None:
+        title = title.strip()
+
+    rows = []
+    for row in parser.rows:
+        if row[0] == "volume":
+            rows.append(["volume", parser.get_text(row[1])])
+            continue
+        entry = row[2]
+        url = None
+        chaptitle = None
+        if entry["link"] != None:
+            url = entry["link"].attrs.get("href")
+            chaptitle = parser.get_text(entry["link"])
+        datetime = None
+        if entry["span"] != None:
+            datetime = entry["span"].attrs.get("title")
+        elif entry["long_update"] != None:
+            datetime = parser.get_text(entry["long_update"])
+        rows.append(["chapter", url, chaptitle, datetime, "novel_sublist2" in row[1].classes])
+    return (title, rows)
+
+if __name__ == "__main__":
+    # differential check against the old BeautifulSoup code, using the selectors it used
+    import sys
+    import os
+    from bs4 import BeautifulSoup
+
+    def novel_view_bs4(html):
+        soup = BeautifulSoup(html, "html.parser")
+        text = ""
+        for entry in soup.select(".novel_view"):
+            text += str(entry)
+        return text
+
+    def text_bs4(html):
+        return BeautifulSoup(html, "html.parser").get_text()
+
+    # the first span's title inside .long_update, or else its text
+    def update_time_bs4(entry):
+        dt = entry.select(".long_update")
+        if len(dt) == 0:
+            return None
+        updates = dt[0].select("span")
+        if len(updates) > 0:
+            return updates[0].get("title")
+        return dt[0].get_text()
+
+    # The old code walked index pages twice: update_volumes went through every child of .index_box (volume titles and chapter rows),
+    # and the chapters to download were every .index_box .novel_sublist2. Returns (title, volume walk, chapters).
+    def index_bs4(html):
+        soup = BeautifulSoup(html, "html.parser")
+        title = soup.select("#novel_color .novel_title")
+        if len(title) == 0:
+            title = None
+        else:
+            title = title[0].get_text().strip()
+        volumes = []
+        for entry in soup.select(".index_box > *"):
+            if entry.name == "div":
+                volumes.append(["volume", entry.get_text()])
+                continue
+            li = entry.select(".subtitle a")
+            volumes.append(["chapter", li[0].get("href") if len(li) > 0 else None, update_time_bs4(entry)])
+        chapters = []
+        for entry in soup.select(".index_box .novel_sublist2"):
+            li = entry.select(".subtitle a")
+            if len(li) == 0:
+                chapters.append([None, None, update_time_bs4(entry)])
+            else:
+                chapters.append([li[0].get("href"), li[0].get_text(), update_time_bs4(entry)])
+        return (title, volumes, chapters)
+
+    # the same, from parse_index's rows, the way Ripper.update_volumes and Ripper.plan_story read them
+    def index_fast(html):
+        (title, rows) = parse_index(html)
+        volumes = [["volume", row[1]] if row[0] == "volume" else ["chapter", row[1], row[3]] for row in rows]
+        chapters = [[row[1], row[2], row[3]] for row in rows if row[0] == "chapter" and row[4]]
+        return (title, volumes, chapters)
+
+    # with no arguments, checks the saved pages that come with this
+    arguments = sys.argv[1:]
+    if len(arguments) == 0:
+        arguments = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "extract_corpus")]
+    paths = []
+    for arg in arguments:
+        if os.path.isdir(arg):
+            for name in sorted(os.listdir(arg)):
+                if name.endswith(".html"):
+                    paths.append(os.path.join(arg, name))
+        else:
+            paths.append(arg)
+    if len(paths) == 0:
+        print("no pages to check")
+        sys.exit(1)
+
+    failures = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        for (what, fast, slow) in [("novel_view", extract_novel_view, novel_view_bs4), ("index", index_fast, index_bs4), ("text", html_to_text, text_bs4)]:
+            a = fast(html)
+            b = slow(html)
+            if a != b:
+                failures += 1
+                print(f"MISMATCH ({what}) in {path}")
+                print(f"  fast: {a!r}"[:2000])
+                print(f"  bs4:  {b!r}"[:2000])
+    print(f"checked {len(paths)} files, {failures} mismatches")
+    if failures > 0:
+        sys.exit(1)
@@ -0,0 +1,162 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Counts and times what a ripping run does, and writes it out as a report at the end (JSON, and optionally Prometheus' text format),
+# so runs from cron can be compared with each other without reading their output.
+
+import json
+import math
+import os
+import time
+
+# upper bounds, in seconds, of the buckets request latencies are counted in
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf]
+
+class Histogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.counts = [0 for bucket in buckets]
+        self.count = 0
+        self.sum = 0
+    
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for (i, bucket) in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                return
+    
+    # upper bound of the bucket the given quantile falls in
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        seen = 0
+        for (bucket, count) in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bucket
+        return self.buckets[-1]
+    
+    def cumulative(self):
+        seen = 0
+        result = []
+        for (bucket, count) in zip(self.buckets, self.counts):
+            seen += count
+            result += [(bucket, seen)]
+        return result
+
+class Timer:
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+    def __enter__(self):
+        self.start = time.perf_counter()
+    def __exit__(self, kind, value, traceback):
+        self.metrics.add_phase(self.phase, time.perf_counter() - self.start)
+
+# Counters and histograms are identified by a name and a set of labels (like kind="chapter", status="200").
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+    
+    # Time spent in each part of the run. Parts that happen at the same time (like index pages being fetched while chapters download) overlap,
+    # so they can add up to more than the total.
+    def timed(self, phase):
+        return Timer(self, phase)
+    
+    def add_phase(self, phase, seconds):
+        (total, count) = self.phases.get(phase, (0, 0))
+        self.phases[phase] = (total + seconds, count + 1)
+    
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+    
+    # sum of a counter over every label that isn't given
+    def get(self, name, **labels):
+        total = 0
+        for ((counter, counter_labels), value) in self.counters.items():
+            if counter == name and all(item in counter_labels for item in labels.items()):
+                total += value
+        return total
+    
+    def report(self, extra={}):
+        counters = {}
+        for ((name, labels), value) in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        histograms = {}
+        for ((name, labels), histogram) in sorted(self.histograms.items(), key=lambda item: item[0]):
+            histograms.setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "p50": histogram.quantile(0.5),
+                "p90": histogram.quantile(0.9),
+                "p99": histogram.quantile(0.99),
+                "buckets": [[str(bucket) if bucket == math.inf else bucket, count] for (bucket, count) in histogram.cumulative()],
+            })
+        report = {
+            "started": self.started,
+            "total": time.perf_counter() - self.started_perf,
+            "phases": {phase: {"seconds": seconds, "count": count} for (phase, (seconds, count)) in sorted(self.phases.items())},
+            "counters": counters,
+            "histograms": histograms,
+        }
+        report.update(extra)
+        return report
+    
+    def write_json(self, path, extra={}):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.report(extra), f, indent=1, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    
+    # Prometheus' text exposition format. Everything is about the last run, so counters are written as gauges.
+    # Written to a temporary file and then renamed, so a collector (like node_exporter's textfile collector) never reads half a file.
+    def write_prometheus(self, path, prefix="narourip"):
+        lines = []
+        def labelstring(labels):
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for (key, value) in labels) + "}"
+        
+        lines += [f"# TYPE {prefix}_last_run_timestamp_seconds gauge", f"{prefix}_last_run_timestamp_seconds {self.started}"]
+        lines += [f"# TYPE {prefix}_run_seconds gauge", f"{prefix}_run_seconds {time.perf_counter() - self.started_perf}"]
+        lines += [f"# TYPE {prefix}_phase_seconds gauge"]
+        lines += [f'{prefix}_phase_seconds{{phase="{phase}"}} {seconds}' for (phase, (seconds, count)) in sorted(self.phases.items())]
+        lines += [f"# TYPE {prefix}_phase_count gauge"]
+        lines += [f'{prefix}_phase_count{{phase="{phase}"}} {count}' for (phase, (seconds, count)) in sorted(self.phases.items())]
+        
+        names = sorted(set(name for (name, labels) in self.counters))
+        for name in names:
+            lines += [f"# TYPE {prefix}_{name} gauge"]
+            for ((counter, labels), value) in sorted(self.counters.items()):
+                if counter == name:
+                    lines += [f"{prefix}_{name}{labelstring(labels)} {value}"]
+        
+        names = sorted(set(name for (name, labels) in self.histograms))
+        for name in names:
+            lines += [f"# TYPE {prefix}_{name} histogram"]
+            for ((histogram_name, labels), histogram) in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                for (bucket, count) in histogram.cumulative():
+                    le = "+Inf" if bucket == math.inf else str(bucket)
+                    lines += [f"{prefix}_{name}_bucket{labelstring(labels + (('le', le),))} {count}"]
+                lines += [f"{prefix}_{name}_sum{labelstring(labels)} {histogram.sum}"]
+                lines += [f"{prefix}_{name}_count{labelstring(labels)} {histogram.count}"]
+        
+        with open(path + ".tmp", "w", encoding="utf-8", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
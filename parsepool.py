@@ -0,0 +1,44 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# An optional pool of worker processes to parse HTML (and compress, and dump stories) in, so that it doesn't hold up the event loop
+# or leave the other CPU cores idle. With 0 workers everything just runs in the calling process.
+
+import asyncio
+import concurrent.futures
+from extract import map_list
+
+class ParsePool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+    
+    # Starts the worker processes. Best done before anything else (like an event loop's threads) is going on.
+    def start(self):
+        if self.pool == None and self.workers > 0:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            self.pool.submit(int).result()
+        return self.pool
+    
+    # Like map(function, items) but spread across the workers. Results come back in order, as they're ready.
+    def map(self, function, items):
+        pool = self.start()
+        if pool == None:
+            return map(function, items)
+        return pool.map(function, items, chunksize=4)
+    
+    # Same, for use in an event loop. Returns a list.
+    async def map_async(self, function, items):
+        pool = self.start()
+        if pool == None:
+            return [function(item) for item in items]
+        size = max(1, -(-len(items) // self.workers))
+        chunks = [items[i:i+size] for i in range(0, len(items), size)]
+        results = await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(pool, map_list, function, chunk) for chunk in chunks])
+        return [result for chunk in results for result in chunk]
+    
+    def close(self):
+        if self.pool != None:
+            self.pool.shutdown()
+            self.pool = None
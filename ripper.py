@@ -0,0 +1,1042 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Ripping stories from narou into a database. rip.py is the command line interface to this; anything else can use it too,
+# e.g. to keep one process (with one database connection and one pool of HTTP connections) running and sync stories from it:
+#
+#     database = store.open_database("naroudb.db")
+#     async with Ripper(database) as ripper:
+#         await ripper.sync_story("n1701bm")
+#         print(ripper.store.title("n1701bm"))
+#
+# Nothing happens when this is imported. Settings come from settings.py unless a Ripper is given its own.
+
+import asyncio
+import aiohttp
+import gzip
+import json
+import math
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from functools import partial
+from urllib.parse import urljoin
+import codec
+import metrics
+import settings as default_settings
+from extract import extract_chapter, parse_index
+from parsepool import ParsePool
+from store import Store
+
+def response_text_indicates_ratelimit(string):
+    return "Too many access!" in string
+
+def response_code_indicates_ratelimit(code):
+    return code == 503
+
+# for metrics
+def request_kind(url):
+    url = str(url)
+    if "api.syosetu.com" in url:
+        return "novelapi"
+    if "yomou.syosetu.com" in url:
+        return "ranking"
+    if re.search("syosetu.com/[^/]+/[^/]+/?$", url):
+        return "chapter"
+    return "index"
+
+# Requests are paced by a token bucket instead of by downloading a batch and then sleeping.
+class TokenBucket:
+    def __init__(self, rate, capacity, metrics):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.metrics = metrics
+        # how many processes share the rate (see SharedTokenBucket)
+        self.active = 1
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            with self.metrics.timed("pacing_sleep"):
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    def set_rate(self, rate):
+        self.rate = rate
+    def drain(self):
+        self.tokens = 0
+    # the RateController pauses on its own; only other processes need to be told
+    def pause(self, seconds):
+        pass
+    def close(self):
+        pass
+
+# A token bucket shared by every rip.py on this computer, through a small sqlite database, so that together they stay under the rate.
+# Every process that's making requests gets an equal share of the rate on top of that; processes that haven't asked for a token
+# in the last few seconds stop counting, so the ones that are still going get their share back.
+# The rate itself is shared too: when one process gets ratelimited, all of them slow down (and wait out the pause).
+class SharedTokenBucket:
+    # seconds since its last request after which a process no longer counts as sharing the rate
+    active_window = 5
+    
+    # max_rate is the most this process takes, whatever the shared rate is (other processes can have different settings)
+    def __init__(self, path, rate, capacity, metrics, max_rate):
+        self.capacity = capacity
+        self.max_rate = max_rate
+        self.metrics = metrics
+        self.id = f"{os.getpid()}:{id(self)}"
+        self.new_rate = None
+        self.drained = False
+        self.paused_until = 0
+        self.active = 1
+        # autocommit, so every token is its own BEGIN IMMEDIATE transaction. processes wait for each other instead of failing on a locked database.
+        self.database = sqlite3.connect(path, timeout=30, isolation_level=None)
+        database = self.database
+        database.execute("PRAGMA journal_mode=WAL")
+        database.execute("CREATE table if not exists bucket (id integer primary key, rate real, tokens real, last real, paused_until real)")
+        database.execute("CREATE table if not exists participants (id text primary key, tokens real, last real, seen real)")
+        now = time.time()
+        database.execute("BEGIN IMMEDIATE")
+        # if nobody else is running, our rate is the one to use. otherwise we go along with theirs.
+        if database.execute("SELECT count(*) from participants where seen>=?", (now - self.active_window,)).fetchone()[0] == 0:
+            database.execute("INSERT or replace into bucket values (1,?,?,?,0)", (rate, capacity, now))
+        self.rate = database.execute("SELECT rate from bucket where id=1").fetchone()[0]
+        database.execute("COMMIT")
+        # from here on, this runs on the event loop: a locked database fails right away and acquire() waits for it asynchronously, instead of
+        # every download in the process stopping until the lock is free. tokens don't need to survive a power cut, so commits don't need an fsync.
+        database.execute("PRAGMA busy_timeout=0")
+        database.execute("PRAGMA synchronous=NORMAL")
+    
+    # Takes a token if there is one. Returns how many seconds to wait before trying again if there isn't (0 if there was).
+    def take(self):
+        database = self.database
+        now = time.time()
+        database.execute("BEGIN IMMEDIATE")
+        try:
+            (rate, tokens, last, paused_until) = database.execute("SELECT rate, tokens, last, paused_until from bucket where id=1").fetchone()
+            if self.new_rate != None:
+                rate = self.new_rate
+            tokens = min(self.capacity, tokens + max(now - last, 0) * rate)
+            if self.drained:
+                tokens = 0
+            paused_until = max(paused_until, self.paused_until)
+            (self.new_rate, self.drained) = (None, False)
+            
+            # we only start counting once we make requests
+            database.execute("INSERT or ignore into participants values (?,1,?,?)", (self.id, now, now))
+            database.execute("UPDATE participants set seen=? where id=?", (now, self.id))
+            # processes that died without saying so
+            database.execute("DELETE from participants where seen<?", (now - 60,))
+            active = database.execute("SELECT count(*) from participants where seen>=?", (now - self.active_window,)).fetchone()[0]
+            share = min(rate / active, self.max_rate)
+            (mine, mine_last) = database.execute("SELECT tokens, last from participants where id=?", (self.id,)).fetchone()
+            mine = min(max(self.capacity / active, 1), mine + max(now - mine_last, 0) * share)
+            
+            wait = 0
+            if paused_until > now:
+                wait = paused_until - now
+            elif tokens < 1 or mine < 1:
+                wait = max((1 - tokens) / rate, (1 - mine) / share)
+            else:
+                tokens -= 1
+                mine -= 1
+            database.execute("UPDATE bucket set rate=?, tokens=?, last=?, paused_until=? where id=1", (rate, tokens, now, paused_until))
+            database.execute("UPDATE participants set tokens=?, last=? where id=?", (mine, now, self.id))
+            database.execute("COMMIT")
+        except:
+            database.execute("ROLLBACK")
+            raise
+        self.rate = rate
+        self.active = active
+        return wait
+    
+    async def acquire(self):
+        while True:
+            try:
+                wait = self.take()
+            except sqlite3.OperationalError as e:
+                # another process is taking a token right now
+                if "locked" not in str(e):
+                    raise
+                wait = 0.005
+            if wait == 0:
+                return
+            with self.metrics.timed("pacing_sleep"):
+                await asyncio.sleep(wait)
+    
+    # these take effect (for every process) with the next token
+    def set_rate(self, rate):
+        self.rate = rate
+        self.new_rate = rate
+    def drain(self):
+        self.drained = True
+    def pause(self, seconds):
+        self.paused_until = time.time() + seconds
+    
+    def close(self):
+        if self.database != None:
+            try:
+                self.database.execute("DELETE from participants where id=?", (self.id,))
+            except sqlite3.OperationalError:
+                # the others stop counting us after active_window seconds anyway
+                pass
+            self.database.close()
+            self.database = None
+
+# Decides how fast and how many requests at once we send, based on whether narou is ratelimiting us.
+class RateController:
+    def __init__(self, settings, store, metrics):
+        self.settings = settings
+        self.store = store
+        self.metrics = metrics
+        self.rate = settings.chapters_per_second
+        self.connections = settings.limit_connections
+        if settings.adaptive_ratelimit:
+            self.rate = float(store.get_state("ratelimit_rate", self.rate))
+            self.connections = int(store.get_state("ratelimit_connections", self.connections))
+            self.rate = self.clamp(self.rate)
+            self.connections = min(max(self.connections, 1), settings.limit_connections)
+        if settings.shared_ratelimit:
+            path = settings.shared_ratelimit_path
+            if path == None:
+                path = os.path.join(tempfile.gettempdir(), "narourip_ratelimit.db")
+            self.bucket = SharedTokenBucket(path, self.rate, settings.token_bucket_size, metrics, self.clamp(math.inf))
+            # a rate left behind by a process with other settings gets brought within ours
+            self.rate = self.clamp(self.bucket.rate)
+            if self.rate != self.bucket.rate:
+                self.bucket.set_rate(self.rate)
+        else:
+            self.bucket = TokenBucket(self.rate, settings.token_bucket_size, metrics)
+        self.in_flight = 0
+        self.slots = None
+        self.successes = 0
+        # failed requests (timeouts, disconnects) since the last one that went through
+        self.failures = 0
+        self.backoff = settings.wait_if_ratelimited
+        self.paused_until = 0
+        # an extra limit every request waits for first, if set (something with an async acquire(), like --watch's hourly budget)
+        self.budget = None
+    
+    # Keeps a rate within min/max_chapters_per_second, or under chapters_per_second if the rate isn't adaptive.
+    def clamp(self, rate):
+        settings = self.settings
+        if not settings.adaptive_ratelimit:
+            return min(rate, settings.chapters_per_second)
+        return min(max(rate, settings.min_chapters_per_second), settings.max_chapters_per_second)
+    
+    def pause_remaining(self):
+        return max(0, self.paused_until - time.monotonic())
+    
+    async def acquire(self):
+        if self.slots == None:
+            self.slots = asyncio.Condition()
+        if self.budget != None:
+            await self.budget.acquire()
+        while True:
+            wait = self.pause_remaining()
+            if wait > 0:
+                with self.metrics.timed("ratelimit_sleep"):
+                    await asyncio.sleep(wait)
+            async with self.slots:
+                # processes sharing the rate share the connections too
+                await self.slots.wait_for(lambda: self.in_flight < max(self.connections // self.bucket.active, 1))
+                self.in_flight += 1
+            await self.bucket.acquire()
+            # another process might have changed the shared rate
+            self.rate = self.clamp(self.bucket.rate)
+            # we might have been ratelimited while waiting for a token
+            if self.pause_remaining() == 0:
+                return
+            await self.release()
+    
+    async def release(self):
+        async with self.slots:
+            self.in_flight -= 1
+            self.slots.notify_all()
+    
+    def on_success(self):
+        settings = self.settings
+        self.successes += 1
+        self.failures = 0
+        self.backoff = settings.wait_if_ratelimited
+        if not settings.adaptive_ratelimit:
+            return
+        # additive increase, about once per second's worth of requests
+        if self.successes >= self.rate:
+            self.successes = 0
+            self.rate = min(self.rate + settings.ratelimit_increase, settings.max_chapters_per_second)
+            self.connections = min(self.connections + 1, settings.limit_connections)
+            self.bucket.set_rate(self.rate)
+    
+    # Narou tends to drop connections instead of answering when it's overloaded, so enough failed requests in a row count as a ratelimit.
+    # Returns how many seconds to wait before retrying.
+    def on_failure(self):
+        self.failures += 1
+        if self.failures < self.settings.failures_before_backoff:
+            return 1
+        self.failures = 0
+        return self.on_ratelimit("too many requests in a row failed")
+    
+    # returns how many seconds to back off for
+    def on_ratelimit(self, reason="you've been ratelimited by narou"):
+        settings = self.settings
+        # requests that were already in flight when we got ratelimited will come back ratelimited too. only react once.
+        if self.pause_remaining() > 0:
+            return self.pause_remaining()
+        self.metrics.count("ratelimits")
+        if settings.adaptive_ratelimit:
+            self.rate = max(self.rate * settings.ratelimit_decrease, settings.min_chapters_per_second)
+            self.connections = max(int(self.connections * settings.ratelimit_decrease), 1)
+            self.bucket.set_rate(self.rate)
+            self.bucket.drain()
+            self.successes = 0
+            self.save()
+            print(f"{reason}. backing off for {self.backoff} seconds and slowing down to {round(self.rate, 2)} requests per second with {self.connections} connections")
+        else:
+            print(f"{reason}. if you keep seeing this warning, wait a while and try again")
+        self.paused_until = time.monotonic() + self.backoff
+        self.bucket.pause(self.backoff)
+        pause = self.backoff
+        self.backoff = min(self.backoff * 2, settings.max_wait_if_ratelimited)
+        return pause
+    
+    def save(self):
+        if self.settings.adaptive_ratelimit:
+            self.store.set_state("ratelimit_rate", str(self.rate))
+            self.store.set_state("ratelimit_connections", str(self.connections))
+    
+    def close(self):
+        self.bucket.close()
+
+class Volume:
+    def __init__(self, name):
+        self.name = name
+        self.chapters = []
+    def stringify(self):
+        string = f"{self.name}"
+        for chapter in self.chapters:
+            string += f"\n  {chapter}"
+        return string
+
+class Story:
+    def __init__(self, ncode, title, rank, novel_datetime, chapters):
+        self.ncode = ncode
+        self.title = title
+        self.rank = rank
+        self.novel_datetime = novel_datetime
+        self.chapters = chapters # url, title, time
+        self.remaining = len(chapters)
+
+# One ripping run. Its journal (job) says which stories it's going to look at and how far it got: stories start out "pending",
+# become "planned" once we know which of their chapters to download (those go into job_chapters), and end up "done",
+# or "skipped" if there turned out to be nothing to do.
+class Run:
+    def __init__(self, job, goodranks, delta_discovery, started):
+        self.job = job
+        self.goodranks = goodranks
+        self.delta_discovery = delta_discovery
+        self.started = started
+        # ncodes that delta discovery found only got new chapters since the last run (see plan_story)
+        self.appended = set()
+
+class Ripper:
+    # database is an open sqlite3 connection. session is an aiohttp.ClientSession to make requests with; by default the Ripper makes its own
+    # (with the connection limits from its settings) and closes it when it's closed. Pass trace_configs=[ripper.trace_config()] when making
+    # a session for a Ripper to keep its request metrics working.
+    def __init__(self, database, session=None, settings=None, parse_pool=None):
+        if settings == None:
+            settings = default_settings.load()
+        self.settings = settings
+        self.owns_parse_pool = parse_pool == None
+        if parse_pool == None:
+            parse_pool = ParsePool(settings.parse_workers)
+        self.parse_pool = parse_pool
+        # start the parse workers before an event loop starts any threads
+        self.parse_pool.start()
+        self.store = Store(database, settings.content_compression, self.parse_pool)
+        self.c = self.store.c
+        self.metrics = metrics.Metrics()
+        self.timed = self.metrics.timed
+        self.controller = RateController(settings, self.store, self.metrics)
+        self.session = session
+        self.owns_session = session == None
+        # stories that turned out not to exist (anymore)
+        self.dead = []
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, kind, value, traceback):
+        await self.close()
+    
+    async def close(self):
+        # anything that made requests might have changed the rate
+        if self.session != None:
+            self.controller.save()
+        self.controller.close()
+        self.store.commit()
+        if self.owns_session and self.session != None:
+            await self.session.close()
+            self.session = None
+        if self.owns_parse_pool:
+            self.parse_pool.close()
+    
+    def trace_config(self):
+        # latency is measured until the response headers arrive
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+        async def on_request_end(session, context, params):
+            kind = request_kind(params.url)
+            self.metrics.count("requests", kind=kind, status=str(params.response.status))
+            self.metrics.observe("request_seconds", time.perf_counter() - context.start, kind=kind)
+        async def on_request_exception(session, context, params):
+            self.metrics.count("requests", kind=request_kind(params.url), status="exception")
+        async def on_connection_create_end(session, context, params):
+            self.metrics.count("connections_opened")
+        async def on_connection_reuseconn(session, context, params):
+            self.metrics.count("connections_reused")
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+    
+    # One HTTP session (and one pool of keep-alive connections) is shared by everything the Ripper does.
+    async def get_session(self):
+        if self.session == None:
+            settings = self.settings
+            local_addr = None if settings.local_address == None else (settings.local_address, 0)
+            connector = aiohttp.TCPConnector(ttl_dns_cache=100000000, limit=settings.limit_connections, limit_per_host=settings.limit_connections_per_host, keepalive_timeout=settings.keepalive_timeout, enable_cleanup_closed=True, local_addr=local_addr)
+            # trust_env so that http_proxy etc. keep working the way they did with urllib
+            self.session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': 'Mozilla/5.0'}, trace_configs=[self.trace_config()], trust_env=True)
+        return self.session
+    
+    # Returns (status, headers, data). Keeps retrying until it gets a 200, or a 304 if the request was conditional.
+    async def get_http_response(self, url, headers={}):
+        session = await self.get_session()
+        controller = self.controller
+        while True:
+            await controller.acquire()
+            try:
+                async with session.get(url, headers=headers, timeout=self.settings.page_timeout) as response:
+                    status = response.status
+                    response_headers = response.headers
+                    data = await response.read()
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                print(f"(exception `{e}`; retrying)")
+                self.metrics.count("retries", kind=request_kind(url), reason="exception")
+                await asyncio.sleep(controller.on_failure())
+                continue
+            finally:
+                await controller.release()
+            
+            self.metrics.count("bytes", len(data), kind=request_kind(url))
+            if response_code_indicates_ratelimit(status) or response_text_indicates_ratelimit(data.decode("utf-8", "replace")):
+                self.metrics.count("retries", kind=request_kind(url), reason="ratelimit")
+                with self.timed("ratelimit_sleep"):
+                    await asyncio.sleep(controller.on_ratelimit())
+            elif status != 200 and not (status == 304 and len(headers) > 0):
+                print(f"(got status {status} for {url}; retrying)")
+                self.metrics.count("retries", kind=request_kind(url), reason="status")
+                await asyncio.sleep(1)
+            else:
+                controller.on_success()
+                return (status, response_headers, data)
+    
+    async def get_http_data(self, url):
+        return (await self.get_http_response(url))[2]
+    
+    # Returns [[story url, rank], ...] from one of yomou's ranking pages.
+    async def get_ranking(self, url="http://yomou.syosetu.com/rank/list/type/total_total/"):
+        # only needed for this, so only imported for this
+        import yomou
+        with self.timed("ranking"):
+            return yomou.parse_ranking(await self.get_http_data(url))
+    
+    # Fetches the given ranking lists (by name, see yomou.ranking_url) all at once, and keeps today's snapshot of each in the rank history.
+    # Returns {list name: [[story url, rank], ...]}.
+    async def get_rankings(self, names):
+        import yomou
+        rankings = await asyncio.gather(*[self.get_ranking(yomou.ranking_url(name)) for name in names])
+        date = time.strftime("%Y-%m-%d")
+        for (name, ranking) in zip(names, rankings):
+            self.store.record_ranking(name, date, ranking)
+        self.store.commit()
+        return dict(zip(names, rankings))
+    
+    # Returns the parsed index page of a story and whether it changed since it was cached.
+    async def get_index_page(self, ncode, mainurl):
+        c = self.c
+        cached = None
+        headers = {}
+        if self.settings.use_index_cache:
+            cached = c.execute("SELECT etag, last_modified, title, rows from index_cache where ncode=?", (ncode,)).fetchone()
+        if cached != None:
+            if cached[0] != None:
+                headers["If-None-Match"] = cached[0]
+            if cached[1] != None:
+                headers["If-Modified-Since"] = cached[1]
+        
+        with self.timed("index_fetch"):
+            (status, response_headers, data) = await self.get_http_response(mainurl, headers)
+        
+        if status == 304:
+            return (cached[2], json.loads(cached[3]), False)
+        
+        with self.timed("index_parse"):
+            (title, rows) = (await self.parse_pool.map_async(parse_index, [data]))[0]
+        
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        if self.settings.use_index_cache and title != None and (etag != None or last_modified != None):
+            c.execute("INSERT or replace into index_cache values (?,?,?,?,?,?)", (ncode, etag, last_modified, title, json.dumps(rows, ensure_ascii=False), int(time.time())))
+        return (title, rows, True)
+    
+    # arguments are [story url or ncode, rank]
+    def update_ranks(self, arguments):
+        c = self.c
+        for argument in arguments:
+            mainurl = argument[0]
+            ncode = mainurl.rstrip("/").rsplit('/', 1)[-1]
+            rank = argument[1]
+            if rank != None and int(rank) < 1:
+                rank = None
+            c.execute("UPDATE ranks set rank=null where rank=(?)", (rank,))
+            c.execute("UPDATE ranks set rank=? where ncode=?", (rank, ncode))
+    
+    async def get_novelapi(self, query):
+        with self.timed("novelapi"):
+            data = await self.get_http_data(f"http://api.syosetu.com/novelapi/api/?out=json&gzip=5&{query}")
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        return json.loads(data)
+    
+    # Fetches everything novelapi knows about the given stories into novel_meta, novelapi_batch_size stories per request.
+    # Returns the set of ncodes that novelapi knows about.
+    async def sync_metadata(self, ncodes):
+        batch_size = self.settings.novelapi_batch_size
+        batches = [ncodes[i:i+batch_size] for i in range(0, len(ncodes), batch_size)]
+        
+        async def sync_batch(batch):
+            return (await self.get_novelapi(f"lim={len(batch)}&ncode={'-'.join(batch)}"))[1:]
+        
+        infos = await asyncio.gather(*[sync_batch(batch) for batch in batches])
+        
+        synced = time.strftime("%Y-%m-%d %H:%M:%S")
+        found = set()
+        rows = []
+        summaries = []
+        for info in infos:
+            for etc in info:
+                ncode = etc["ncode"].lower()
+                found.add(ncode)
+                rows += [(ncode, etc.get("title"), etc.get("writer"), etc.get("general_all_no"), etc.get("length"), etc.get("end"), etc.get("novel_type"), etc.get("general_firstup"), etc.get("general_lastup"), etc.get("novelupdated_at"), etc.get("updated_at"), synced, json.dumps(etc, ensure_ascii=False))]
+                summaries += [(ncode, etc.get("story"))]
+        self.c.executemany("INSERT or replace into novel_meta values (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        self.c.executemany("INSERT or replace into summaries values (?,?)", summaries)
+        self.c.executemany("INSERT or ignore into novel_updates values (?,?)", [(row[0], row[9]) for row in rows if row[9] != None])
+        self.store.commit()
+        print(f"got info for {len(found)} stories in {len(batches)} requests")
+        return found
+    
+    # Finds out which of the given known stories changed since the given unix time, without asking novelapi about each of them.
+    # If few enough stories changed site-wide, we just page through all of them (novelapi can't page past the 2000th result).
+    # Otherwise we ask about our own stories in batches, but only the ones that changed come back.
+    async def discover_changed(self, ncodes, since):
+        if len(ncodes) == 0:
+            return {}
+        query = f"of=n-nu-gl-ga&lastupdate={since}-{int(time.time())}"
+        batch_size = self.settings.novelapi_batch_size
+        
+        first = await self.get_novelapi(f"{query}&order=old&lim=500&st=1")
+        allcount = first[0]["allcount"]
+        if allcount <= 2000 + 500 - 1:
+            # st can't go past 2000, so the last page overlaps the one before it instead
+            pages = await asyncio.gather(*[self.get_novelapi(f"{query}&order=old&lim=500&st={min(st, 2000)}") for st in range(501, allcount + 1, 500)])
+            pages += [first]
+        else:
+            batches = [ncodes[i:i+batch_size] for i in range(0, len(ncodes), batch_size)]
+            pages = await asyncio.gather(*[self.get_novelapi(f"{query}&lim={len(batch)}&ncode={'-'.join(batch)}") for batch in batches])
+            pages += [[]]
+        
+        known = set(ncodes)
+        changed = {}
+        for page in pages:
+            for etc in page[1:]:
+                ncode = etc["ncode"].lower()
+                if ncode in known:
+                    changed[ncode] = etc
+        
+        print(f"{len(changed)} of {len(known)} known stories changed since the last update ({len(pages)} requests)")
+        
+        # tell new chapters apart from edits to existing chapters. stories that only got new chapters just need those downloaded.
+        appended = {}
+        for (ncode, etc) in changed.items():
+            appended[ncode] = False
+            stored = self.c.execute("SELECT count(*) from chapters where ncode=?", (ncode,)).fetchone()[0]
+            chapters = etc.get("general_all_no")
+            if chapters == None:
+                print(f"{ncode} changed")
+            elif chapters > stored:
+                print(f"{ncode} has {chapters - stored} new chapters")
+                # an edit made after the newest chapter was posted moves novelupdated_at past general_lastup
+                appended[ncode] = etc.get("novelupdated_at") == etc.get("general_lastup")
+            elif chapters < stored:
+                print(f"{ncode} has fewer chapters than we have stored; some were probably deleted")
+            else:
+                print(f"{ncode} was edited")
+        
+        # ncode -> whether it only got new chapters
+        return appended
+    
+    # Syncs the metadata of the given stories and returns the ones that need to be looked at more closely.
+    async def check_update_dates(self, arguments):
+        ncodes = []
+        for argument in arguments:
+            ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+            if ncode not in ncodes:
+                ncodes += [ncode]
+        
+        found = await self.sync_metadata(ncodes)
+        
+        newargs = []
+        for argument in arguments:
+            mainurl = argument[0]
+            ncode = mainurl.rstrip("/").rsplit('/', 1)[-1]
+            # check if it's up to date or not
+            if ncode not in found:
+                print(f"story {ncode} does not exist, or no longer exists on narou. skipping")
+                self.dead.append(ncode)
+                continue
+            
+            if self.settings.enable_per_novel_datetime_check and self.c.execute("SELECT ranks.datetime from ranks, novel_meta where ranks.ncode=? and novel_meta.ncode=ranks.ncode and ranks.datetime=novel_meta.novelupdated_at", (ncode,)).fetchone() != None:
+                print(f"{ncode} is up to date, skipping")
+                continue
+            
+            print(f"adding {ncode}")
+            newargs += [argument]
+        return newargs
+    
+    # rows come from parse_index
+    def update_volumes(self, ncode, rows):
+        volume_list = []
+        latest_volume = Volume("")
+        for entry in rows:
+            if entry[0] == "volume":
+                if len(latest_volume.chapters) != 0:
+                    volume_list += [latest_volume]
+                latest_volume = Volume(entry[1])
+            else:
+                suburl = entry[1]
+                datetime = entry[3]
+                if suburl == None or datetime == None:
+                    continue
+                datetime = re.search("([0-9]{4}/[0-1][0-9]/[0-9]{2} [0-2][0-9]:[0-5][0-9])", datetime)
+                
+                if ncode not in suburl or datetime is None:
+                    continue
+                
+                chapurl = suburl.rstrip("/").rsplit('/', 1)[-1]
+                latest_volume.chapters += [chapurl]
+        if len(latest_volume.chapters) != 0:
+            volume_list += [latest_volume]
+        
+        c = self.c
+        c.execute("DELETE from volumes where ncode=?", (ncode,))
+        c.execute("DELETE from volume_chapters where ncode=?", (ncode,))
+        c.executemany("INSERT into volumes values (?,?,?)", [(ncode, i, volume.name) for (i, volume) in enumerate(volume_list)])
+        c.executemany("INSERT into volume_chapters values (?,?,?,?)", [(ncode, i, position, int(chapter)) for (i, volume) in enumerate(volume_list) for (position, chapter) in enumerate(volume.chapters)])
+    
+    def start_job(self, arguments, goodranks, delta_discovery, started):
+        c = self.c
+        interrupted = c.execute("SELECT count(*) from jobs where state='running'").fetchone()[0]
+        if interrupted > 0:
+            print("note: the last ripping run was interrupted. you can use --resume to continue an interrupted run instead of starting over")
+            abandon = [(entry[0],) for entry in c.execute("SELECT id from jobs where state='running'").fetchall()]
+            c.executemany("UPDATE jobs set state='abandoned' where id=?", abandon)
+            c.executemany("DELETE from job_stories where job=?", abandon)
+            c.executemany("DELETE from job_chapters where job=?", abandon)
+        c.execute("INSERT into jobs (state, goodranks, delta_discovery, started) values ('running',?,?,?)", (int(goodranks), int(delta_discovery), started))
+        job = c.lastrowid
+        stories = []
+        for argument in arguments:
+            ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+            stories += [(job, ncode, argument[0], argument[1], "pending")]
+        c.executemany("INSERT into job_stories (job, ncode, mainurl, rank, state) values (?,?,?,?,?)", stories)
+        self.store.commit()
+        return Run(job, goodranks, delta_discovery, started)
+    
+    # returns the stories that still need to be planned, and the stories that were planned but still have chapters left
+    def load_job(self, run):
+        c = self.c
+        arguments = []
+        planned = []
+        stories = c.execute("SELECT ncode, mainurl, rank, state, title, novel_datetime from job_stories where job=? and state in ('pending', 'planned') order by rowid", (run.job,)).fetchall()
+        for (ncode, mainurl, rank, state, title, novel_datetime) in stories:
+            if state == "pending":
+                arguments += [[mainurl, rank]]
+            else:
+                chapters = c.execute("SELECT url, chaptitle, datetime from job_chapters where job=? and ncode=? and done=0 order by rowid", (run.job, ncode)).fetchall()
+                planned += [Story(ncode, title, rank, novel_datetime, [list(chapter) for chapter in chapters])]
+        return (arguments, planned)
+    
+    def journal_planned(self, run, story):
+        self.c.executemany("INSERT into job_chapters values (?,?,?,?,?,0)", [(run.job, story.ncode, chapter[0], chapter[1], chapter[2]) for chapter in story.chapters])
+        self.c.execute("UPDATE job_stories set state='planned', title=?, novel_datetime=? where job=? and ncode=?", (story.title, story.novel_datetime, run.job, story.ncode))
+    
+    def journal_skipped(self, run, argument):
+        ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+        self.c.execute("UPDATE job_stories set state='skipped' where job=? and ncode=?", (run.job, ncode))
+    
+    def finish_job(self, run):
+        c = self.c
+        c.execute("UPDATE jobs set state='finished', ended=? where id=?", (int(time.time()), run.job))
+        c.execute("DELETE from job_stories where job=?", (run.job,))
+        c.execute("DELETE from job_chapters where job=?", (run.job,))
+        self.store.commit()
+    
+    def finish_story(self, run, story):
+        c = self.c
+        ncode = story.ncode
+        rank = story.rank
+        novel_datetime = story.novel_datetime
+        if rank == -1:
+            if run.goodranks:
+                c.execute("INSERT or replace into ranks values (?,null,?)", (ncode, novel_datetime))
+            else:
+                rank = c.execute("SELECT rank from ranks where ncode=(?)", (ncode,)).fetchone()
+                if rank != None:
+                    rank = rank[0]
+                c.execute("INSERT or replace into ranks values (?,?,?)", (ncode, rank, novel_datetime))
+        else:
+            c.execute("UPDATE ranks set rank=null where rank=(?)", (rank,))
+            c.execute("INSERT or replace into ranks values (?,?,?)", (ncode, rank, novel_datetime))
+        c.execute("UPDATE job_stories set state='done' where job=? and ncode=?", (run.job, ncode))
+        self.store.commit()
+    
+    # returns None if there's nothing to do for this story. appended means the story only got new chapters since it was last ripped,
+    # so the chapters that are already stored are left alone without comparing their dates.
+    async def plan_story(self, argument, progress_string, appended=False):
+        c = self.c
+        settings = self.settings
+        mainurl = argument[0]
+        rank = argument[1]
+        if "https://" not in mainurl and "http://" not in mainurl:
+            mainurl = "http://ncode.syosetu.com/" + mainurl
+        
+        mainurl = mainurl.replace("https://", "http://")
+        
+        print(f"checking {mainurl} ({progress_string})")
+        
+        ncode = mainurl.rstrip("/").rsplit('/', 1)[-1]
+        
+        # already synced by check_update_dates
+        novel_datetime = c.execute("SELECT novelupdated_at from novel_meta where ncode=?", (ncode,)).fetchone()[0]
+        
+        # doesn't need the index page, so it goes first
+        if settings.enable_per_novel_datetime_check and c.execute("SELECT datetime from ranks where ncode=? and datetime=?", (ncode, novel_datetime)).fetchone() != None:
+            print(f"{ncode} is up to date, skipping")
+            return None
+        
+        (title, rows, changed) = await self.get_index_page(ncode, mainurl)
+        
+        if changed:
+            self.update_volumes(ncode, rows)
+        else:
+            print(f"index page of {ncode} didn't change since last time")
+        
+        if title == None:
+            print(f"story {ncode} does not have a coherent page, skipping.")
+            return None
+        
+        if settings.enable_per_chapter_datetime_check or appended:
+            stored_datetimes = dict(c.execute("SELECT chapter, datetime from chapters where ncode=?", (ncode,)).fetchall())
+        
+        chapterstuff = [] # url, title, time
+        for entry in rows:
+            if entry[0] != "chapter" or not entry[4]:
+                continue
+            suburl = entry[1]
+            datetime = entry[3]
+            if suburl == None or datetime == None:
+                continue
+            datetime = re.search("([0-9]{4}/[0-1][0-9]/[0-9]{2} [0-2][0-9]:[0-5][0-9])", datetime)
+            
+            if ncode not in suburl or datetime is None:
+                continue
+            
+            chapurl = suburl.rstrip("/").rsplit('/', 1)[-1]
+            datetime = datetime[1]
+            
+            if appended and int(chapurl) in stored_datetimes:
+                continue
+            if settings.enable_per_chapter_datetime_check and stored_datetimes.get(int(chapurl)) == datetime:
+                continue
+            
+            chapterstuff += [[urljoin(mainurl, suburl), entry[2], datetime]]
+        
+        print(f"{len(chapterstuff)} chapters to download for {ncode}")
+        
+        return Story(ncode, title, rank, novel_datetime, chapterstuff)
+    
+    # Stories get planned (info + index page) a few at a time while the chapters of already-planned stories download.
+    # Every pending chapter of every story goes into one shared queue, and a fixed pool of workers pulls from it.
+    # planned stories are ones from an interrupted run that already know which chapters they need
+    async def rip_stories(self, run, arguments, planned=[]):
+        c = self.c
+        store = self.store
+        settings = self.settings
+        controller = self.controller
+        queue = asyncio.Queue()
+        
+        total = 0
+        done = 0
+        
+        # downloaded chapters waiting to be parsed and written, as (story, url, chaptitle, datetime, html)
+        pending = []
+        flushing = set()
+        
+        async def planner():
+            nonlocal total
+            prefetch = asyncio.Semaphore(settings.index_prefetch)
+            
+            def enqueue(story):
+                nonlocal total
+                if story.remaining == 0:
+                    self.finish_story(run, story)
+                    return
+                for chapter in story.chapters:
+                    queue.put_nowait((story, chapter))
+                total += story.remaining
+            
+            async def plan(index, argument):
+                async with prefetch:
+                    ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+                    story = await self.plan_story(argument, f"{index+1}/{len(arguments)}", ncode in run.appended)
+                if story == None:
+                    self.journal_skipped(run, argument)
+                    store.commit()
+                    return
+                self.journal_planned(run, story)
+                store.commit()
+                enqueue(story)
+            
+            for story in planned:
+                print(f"{story.remaining} chapters left to download for {story.ncode}")
+                enqueue(story)
+            await asyncio.gather(*[plan(index, argument) for (index, argument) in enumerate(arguments)])
+            store.commit()
+        
+        # Returns (status, text). status is None if the request failed (timeout, disconnect, etc).
+        async def fetch(url):
+            session = await self.get_session()
+            try:
+                async with session.get(url, timeout=settings.chapter_timeout) as response:
+                    if response.status != 200:
+                        return response.status, None
+                    data = await response.read()
+                    self.metrics.count("bytes", len(data), kind="chapter")
+                    return response.status, data.decode(response.get_encoding())
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                # retried by worker(), through the rate controller like any other request
+                return None, None
+        
+        # Parses a batch of downloaded chapters (in the parse workers, if any) and writes them to the database.
+        # Chapters get downloaded again whenever their date changes, but often come back exactly the same. Those only get their date updated.
+        # Chapters that really did change keep their earlier version in chapter_history.
+        async def flush(batch):
+            nonlocal done
+            with self.timed("chapter_parse"):
+                results = await self.parse_pool.map_async(extract_chapter, [entry[4] for entry in batch])
+            
+            changed = []
+            unchanged = []
+            edited = [] # ncode, chapter, datetime and hash of the stored version, stored content
+            for (entry, result) in zip(batch, results):
+                (story, url, chaptitle, datetime, html) = entry
+                chapter = int(url.rstrip("/").rsplit('/', 1)[-1])
+                stored = c.execute("SELECT hash from chapters where ncode=? and chapter=?", (story.ncode, chapter)).fetchone()
+                if stored != None and stored[0] == result[3]:
+                    unchanged += [(chaptitle, datetime, story.ncode, chapter)]
+                    continue
+                changed += [(story.ncode, chapter, chaptitle, datetime, result)]
+                if stored != None:
+                    edited += [(story.ncode, chapter) + c.execute("SELECT datetime, hash, decode_content(content) from chapters where ncode=? and chapter=?", (story.ncode, chapter)).fetchone()]
+            
+            with self.timed("compress"):
+                encoded = await self.parse_pool.map_async(partial(codec.encode_pair, method=store.content_compression, dictionary=store.compression_dict), [(content, text) for (ncode, chapter, chaptitle, datetime, (content, text, charcount, hash)) in changed])
+            with self.timed("delta"):
+                new_contents = {(ncode, chapter): result[0] for (ncode, chapter, chaptitle, datetime, result) in changed}
+                deltas = await self.parse_pool.map_async(partial(codec.encode_delta, method=store.content_compression, dictionary=store.compression_dict), [(new_contents[(entry[0], entry[1])], entry[4]) for entry in edited])
+            
+            db_write = self.timed("db_write")
+            db_write.__enter__()
+            rows = []
+            texts = []
+            for ((ncode, chapter, chaptitle, datetime, (content, text, charcount, hash)), (stored_content, stored_text)) in zip(changed, encoded):
+                rows += [(ncode, chapter, chaptitle, datetime, stored_content, stored_text, charcount, hash)]
+                texts += [(ncode, chapter, text)]
+            
+            c.executemany("INSERT into novels values (?,?) on conflict(ncode) do update set title=excluded.title", set((entry[0].ncode, entry[0].title) for entry in batch))
+            store.add_revisions([(ncode, chapter, datetime, hash, delta) for ((ncode, chapter, datetime, hash, content), delta) in zip(edited, deltas)])
+            store.unindex_chapters([(ncode, chapter) for (ncode, chapter, text) in texts])
+            c.executemany("INSERT or replace into chapters values (?,?,?,?,?,?,?,?)", rows)
+            store.index_chapters(texts)
+            c.executemany("UPDATE chapters set chaptitle=?, datetime=? where ncode=? and chapter=?", unchanged)
+            c.executemany("UPDATE job_chapters set done=1 where job=? and url=?", [(run.job, entry[1]) for entry in batch])
+            
+            for entry in batch:
+                story = entry[0]
+                done += 1
+                story.remaining -= 1
+                if story.remaining == 0:
+                    self.finish_story(run, story)
+                    print(f"done with {story.ncode}")
+            store.update_novel_stats(set(entry[0].ncode for entry in batch))
+            store.commit()
+            db_write.__exit__(None, None, None)
+            self.metrics.count("chapters", len(batch))
+            self.metrics.count("unchanged_chapters", len(unchanged))
+            self.metrics.count("revisions", len(edited))
+            print(f"{done}/{total} chapters downloaded so far")
+        
+        def start_flush():
+            nonlocal pending
+            batch = pending
+            pending = []
+            task = asyncio.create_task(flush(batch))
+            flushing.add(task)
+            task.add_done_callback(flushing.discard)
+        
+        async def worker():
+            while True:
+                story, chapter = await queue.get()
+                try:
+                    url, chaptitle, datetime = chapter
+                    
+                    with self.timed("throttle"):
+                        await controller.acquire()
+                    try:
+                        with self.timed("chapter_fetch"):
+                            status, text = await fetch(url)
+                    finally:
+                        await controller.release()
+                    
+                    if status == None:
+                        self.metrics.count("retries", kind="chapter", reason="exception")
+                        await asyncio.sleep(controller.on_failure())
+                        queue.put_nowait((story, chapter))
+                        continue
+                    if response_code_indicates_ratelimit(status) or (text != None and response_text_indicates_ratelimit(text)):
+                        self.metrics.count("retries", kind="chapter", reason="ratelimit")
+                        controller.on_ratelimit()
+                        queue.put_nowait((story, chapter))
+                        continue
+                    if text == None:
+                        print(f"(got status {status} for {url}; retrying)")
+                        self.metrics.count("retries", kind="chapter", reason="status")
+                        await asyncio.sleep(1)
+                        queue.put_nowait((story, chapter))
+                        continue
+                    
+                    controller.on_success()
+                    
+                    print(f"loaded {url}")
+                    
+                    pending.append((story, url, chaptitle, datetime, text))
+                    if len(pending) >= settings.limit_chapters_at_once:
+                        start_flush()
+                finally:
+                    queue.task_done()
+        
+        workers = [asyncio.create_task(worker()) for i in range(settings.limit_connections)]
+        try:
+            await planner()
+            await queue.join()
+            # wait for the batches that are still being parsed, then write whatever's left over
+            while len(flushing) > 0:
+                await asyncio.gather(*flushing)
+            if len(pending) > 0:
+                start_flush()
+                await asyncio.gather(*flushing)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            store.commit()
+        
+        if total > 0:
+            print(f"downloaded {done} chapters")
+    
+    def finish_run(self, run):
+        self.controller.save()
+        if run.delta_discovery:
+            self.store.set_state("delta_highwater", str(run.started))
+        self.store.commit()
+    
+    # Brings the given stories up to date. arguments are [story url or ncode, rank]; rank is None for stories that aren't being ranked,
+    # and -1 for stories whose rank should be left alone. goodranks means the ranks are a complete rank list, so stories not on it lose their rank.
+    # delta_discovery only looks at the stories novelapi says changed since the last delta_discovery run.
+    async def sync(self, arguments, goodranks=False, delta_discovery=False):
+        run = Run(None, goodranks, delta_discovery, int(time.time()))
+        appended = set()
+        if goodranks:
+            self.update_ranks(arguments)
+        
+        if delta_discovery and self.store.get_state("delta_highwater") != None:
+            print("looking for changed stories")
+            since = int(self.store.get_state("delta_highwater")) - self.settings.delta_discovery_margin
+            # only stories we already have can be skipped. ranks were already updated above with goodranks; otherwise a story that
+            # comes with a rank still needs it stored.
+            stored = set(self.store.known_ncodes())
+            def skippable(argument):
+                ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+                return ncode in stored and (goodranks or argument[1] == None or argument[1] == -1)
+            known = list(dict.fromkeys(argument[0].rstrip("/").rsplit('/', 1)[-1] for argument in arguments if skippable(argument)))
+            with self.timed("discover"):
+                changed = await self.discover_changed(known, since)
+            appended = set(ncode for (ncode, only_new) in changed.items() if only_new)
+            arguments = [argument for argument in arguments if not skippable(argument) or argument[0].rstrip("/").rsplit('/', 1)[-1] in changed]
+        
+        print("checking update dates")
+        with self.timed("metadata"):
+            arguments = await self.check_update_dates(arguments)
+        
+        if len(arguments) > 0:
+            print("note: each story's update time is only stored once all of its chapters are downloaded. if this gets interrupted, use --resume to pick up where it left off")
+            run = self.start_job(arguments, goodranks, delta_discovery, run.started)
+            run.appended = appended
+            with self.timed("rip"):
+                await self.rip_stories(run, arguments)
+            self.finish_job(run)
+        self.finish_run(run)
+    
+    async def sync_story(self, ncode):
+        await self.sync([[ncode, -1]])
+    
+    # Continues the last run, if it was interrupted. Returns False if there was nothing to continue.
+    async def resume(self):
+        job = self.c.execute("SELECT id, goodranks, delta_discovery, started from jobs where state='running' order by id desc limit 1").fetchone()
+        if job == None:
+            return False
+        run = Run(job[0], job[1] == 1, job[2] == 1, job[3])
+        (arguments, planned) = self.load_job(run)
+        print(f"resuming: {len(planned)} stories were partway through downloading, and {len(arguments)} stories were not looked at yet")
+        with self.timed("rip"):
+            await self.rip_stories(run, arguments, planned)
+        self.finish_job(run)
+        self.finish_run(run)
+        return True
+    
+    # [story ncode, None] for every known story, for sync()
+    def known_arguments(self):
+        return [[ncode, None] for ncode in self.store.known_ncodes()]
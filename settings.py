@@ -0,0 +1,177 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Settings for rip.py, and the defaults for Ripper objects (see ripper.py). Edit them here.
+# A Ripper can also be given its own settings: Ripper(database, settings=settings.load(chapters_per_second=5))
+
+import types
+
+# The database everything gets ripped into (used by rip.py; a Ripper is given an open database instead).
+# default is "naroudb.db"
+database_path = "naroudb.db"
+
+# Number of downloaded chapters to parse and write to the database at once. Chapters from every story being ripped share one download queue, so this does not affect download speed.
+# default is 25
+limit_chapters_at_once = 25
+# Local ratelimit. Reduce this if you get ratelimited by narou.
+# default is 10
+chapters_per_second = 10
+# How many requests can go out back-to-back before the chapters_per_second pacing kicks in.
+# default is 10
+token_bucket_size = 10
+
+# Simultaneous connection limit, reduce this if opening too many connections at once is getting you ratelimited or causing other problems.
+# default is 25
+limit_connections = 25
+# Same, but per host (chapters and index pages come from ncode.syosetu.com, story info comes from api.syosetu.com).
+# default is 25
+limit_connections_per_host = 25
+# One set of connections is kept open and reused for the whole run. Idle connections get closed after this many seconds.
+# default is 30
+keepalive_timeout = 30
+
+
+# try to recover from ratelimits gracefully by waiting this many seconds.
+# if we get ratelimited again right after waiting, the wait doubles each time, up to max_wait_if_ratelimited.
+# default is 10
+wait_if_ratelimited = 10
+# default is 300
+max_wait_if_ratelimited = 300
+
+# Timeouts and dropped connections get retried like any other request. This many of them in a row (with nothing succeeding in between)
+# get treated like a ratelimit, since that's often what they are.
+# default is 5
+failures_before_backoff = 5
+
+# Adapt the request rate and connection count while running instead of sticking to chapters_per_second and limit_connections.
+# The rate slowly creeps upwards while requests succeed, and is cut down sharply whenever narou ratelimits us (additive increase, multiplicative decrease).
+# The rate that was last found to be safe is stored in the database and used as the starting rate of the next run.
+# chapters_per_second is used as the starting rate if nothing is stored yet, and limit_connections becomes the connection ceiling.
+# default is True
+adaptive_ratelimit = True
+# The adaptive rate never goes outside these bounds.
+# default is 0.5
+min_chapters_per_second = 0.5
+# default is 40
+max_chapters_per_second = 40
+# How many chapters per second to add after every second's worth of successful requests.
+# default is 0.5
+ratelimit_increase = 0.5
+# What to multiply the rate and connection count by when we get ratelimited.
+# default is 0.5
+ratelimit_decrease = 0.5
+
+# Share the request rate with every other rip.py running on this computer (through a small database file), so that e.g. an update run from cron
+# and a story ripped by hand at the same time don't get ratelimited together. While several of them are making requests, each gets an equal share
+# of the rate and of limit_connections, and when one gets ratelimited, all of them slow down. A rip.py that starts while others are running uses their rate.
+# default is True
+shared_ratelimit = True
+# Where that file is. None puts it in the system's temporary directory.
+# default is None
+shared_ratelimit_path = None
+
+# Disable this if you need to be 100% certain that each individual chapter's update time is checked. Enable it for a small speed boost when doing minor updates.
+# default is True
+enable_per_novel_datetime_check = True
+# Same but for per-chapter update time. You do not want to set this. Use --deletedatetimedata instead.
+# default is True
+enable_per_chapter_datetime_check = True
+
+# Depending on how far you are from japan and how bad your internet is
+# Values that are too low make connections get reset often and make it more likely to get rate limited
+# Value that are too high make the scraper get "stuck" for long periods of time if a connection silently disappears or is randomly very slow
+# default is 8
+chapter_timeout = 8
+# Same, for index pages and story info, which can be a lot bigger than a single chapter.
+# default is 30
+page_timeout = 30
+
+# The ranking lists --yomou and --updateandyomou get, by the name yomou uses for them in its urls: total_total, daily_total, weekly_total, monthly_total,
+# quarter_total, yearly_total, or the list of one genre, like daily_101 or weekly_201. They're fetched all at once, and every story on them gets ripped.
+# A snapshot of each is kept every day they're fetched (see --rankhistory), but only total_total's ranks are the ones --ranklist shows.
+# default is ["total_total"]
+yomou_lists = ["total_total"]
+
+# How many stories to ask novelapi about per request. 500 is the most novelapi allows.
+# default is 500
+novelapi_batch_size = 500
+
+# With --updateknown and --updateandyomou, only look at known stories that novelapi says changed since the last such run, instead of every known story.
+# The first run (or a run with this disabled) still checks everything.
+# default is True
+use_delta_discovery = True
+# How many seconds before the start of the last run to start looking for changes from. Covers clock differences and stories updated while the last run was going.
+# default is 3600
+delta_discovery_margin = 3600
+
+# Remember each story's index page (and when narou says it last changed), and ask narou to only send it again if it changed since then.
+# default is True
+use_index_cache = True
+
+# How many stories to look up (index page) at the same time while chapters are downloading.
+# default is 4
+index_prefetch = 4
+
+# Number of extra processes to parse HTML in (chapters and index pages while ripping, stored chapters for --text, --charcount and --dumpall).
+# 0 parses everything in the main process.
+# default is 0
+parse_workers = 0
+
+# How to compress the content and text of stored chapters: "none", "zlib", or "zstd" (needs the zstandard module).
+# Only affects chapters downloaded from then on. Use --recompress to recompress everything that's already stored.
+# With zstd, --recompress also trains a dictionary on the stored chapters, which makes every chapter compress much better.
+# default is "none"
+content_compression = "none"
+# Size in bytes of the dictionary --recompress trains for zstd.
+# default is 112640
+zstd_dictionary_size = 112640
+
+# --watch checks each known story again after a while that depends on how often it updates: watch_checks_per_update times
+# per the usual time between its updates (or per the time since it last updated, if that's longer, so stories that stopped updating get checked less and less).
+# default is 24
+watch_checks_per_update = 24
+# No story gets checked more often than this (in seconds)...
+# default is 300
+watch_min_interval = 300
+# ...or less often than this, unless it's completed.
+# default is 86400
+watch_max_interval = 86400
+# How often (in seconds) completed stories get checked, in case they get edited or continued.
+# default is 604800
+watch_completed_interval = 604800
+# The most requests --watch makes per hour, counting everything (checking stories and downloading their new chapters). Checks wait until there's room again.
+# Checking up to novelapi_batch_size stories costs one request, so stories that are due around the same time get checked together.
+# default is 600
+watch_requests_per_hour = 600
+# Stories that are due this many seconds from now get checked along with the ones that are due now.
+# default is 60
+watch_batch_ahead = 60
+
+# Sharded crawling (--shardwork): how many stories a worker leases from the coordination database at a time, and for how many seconds.
+# A worker keeps renewing its lease while it works, so lease_seconds is how long it takes for another worker to take over from one that died.
+# default is 20
+lease_batch_size = 20
+# default is 600
+lease_seconds = 600
+
+# The local IP address to make requests from, for hosts with several (e.g. a different one for each --shardwork worker). None lets the system decide.
+# default is None
+local_address = None
+
+# After every ripping run, write a report of what it did (time spent per phase, requests, latencies, bytes downloaded, retries, ratelimits) to this file as JSON.
+# None to not write one.
+# default is "naroudb_metrics.json"
+metrics_report = "naroudb_metrics.json"
+# Same, in Prometheus' text format (e.g. for node_exporter's textfile collector). None to not write one.
+# default is None
+metrics_prometheus = None
+
+# Returns every setting in this file, with the given ones changed.
+def load(**overrides):
+    values = {name: value for (name, value) in globals().items() if not name.startswith("_") and not callable(value) and not isinstance(value, types.ModuleType)}
+    for name in overrides:
+        if name not in values:
+            raise KeyError(f"there is no setting called {name}")
+    values.update(overrides)
+    return types.SimpleNamespace(**values)
@@ -0,0 +1,113 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Crawling with several workers at once, on one host or several (e.g. one per egress IP).
+# Stories to rip go into a coordination database that every worker can reach (a file on shared storage; sqlite's locking needs to work on it).
+# Each worker leases a few stories at a time from it, rips them into its own shard database, and marks them done; a lease that isn't
+# renewed (because its worker died) runs out, and the stories go to another worker. Workers prefer stories they ripped before,
+# since their shard already has those and only needs what changed. Shards get merged into the main database with --merge (see Store.merge).
+
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+
+def open_coordination(path):
+    # autocommit, so leasing can use its own BEGIN IMMEDIATE transactions. workers wait for each other instead of failing on a locked database.
+    database = sqlite3.connect(path, timeout=60, isolation_level=None)
+    database.execute("PRAGMA journal_mode=WAL")
+    # state is pending, leased, done, or dead (doesn't exist on narou). last_worker is whoever finished it last, and has it in their shard.
+    database.execute("CREATE table if not exists stories (ncode text primary key, mainurl text, rank, state text, worker text, expires int, last_worker text, finished int)")
+    database.execute("CREATE index if not exists idx_stories_state on stories (state, expires)")
+    return database
+
+# Stable between runs, so workers get their own stories back. shard_path is the worker's shard database.
+def worker_name(shard_path):
+    return f"{socket.gethostname()}:{os.path.abspath(shard_path)}"
+
+# arguments are [story url or ncode, rank], like for Ripper.sync. Stories that were already done get ripped again (e.g. to update them),
+# but stories a worker is busy with are left alone.
+def add_stories(coordination, arguments):
+    rows = []
+    for argument in arguments:
+        ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+        rows += [(ncode, argument[0], argument[1])]
+    coordination.execute("BEGIN IMMEDIATE")
+    coordination.executemany("INSERT into stories (ncode, mainurl, rank, state) values (?,?,?,'pending') on conflict(ncode) do update set mainurl=excluded.mainurl, rank=excluded.rank, state='pending' where state!='leased'", rows)
+    coordination.execute("COMMIT")
+
+# Returns up to count [story url or ncode, rank] that the worker now holds for lease_seconds.
+def lease(coordination, worker, count, lease_seconds):
+    now = int(time.time())
+    coordination.execute("BEGIN IMMEDIATE")
+    rows = coordination.execute("SELECT ncode, mainurl, rank from stories where state='pending' or (state='leased' and expires<?) order by last_worker is ? desc, rowid limit ?", (now, worker, count)).fetchall()
+    coordination.executemany("UPDATE stories set state='leased', worker=?, expires=? where ncode=?", [(worker, now + lease_seconds, ncode) for (ncode, mainurl, rank) in rows])
+    coordination.execute("COMMIT")
+    return [[mainurl, rank] for (ncode, mainurl, rank) in rows]
+
+def renew(coordination, worker, lease_seconds):
+    coordination.execute("UPDATE stories set expires=? where state='leased' and worker=?", (int(time.time()) + lease_seconds, worker))
+
+# If the lease ran out and another worker took the story over, it's theirs to finish.
+def finish(coordination, worker, arguments, dead):
+    rows = []
+    for argument in arguments:
+        ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+        rows += [("dead" if ncode in dead else "done", worker, int(time.time()), ncode, worker)]
+    coordination.executemany("UPDATE stories set state=?, last_worker=?, finished=?, worker=null, expires=null where ncode=? and state='leased' and worker=?", rows)
+
+# Copies what the main database (a Store) has of the given stories into the shard, so the worker only downloads what changed since,
+# like a run on the main database would. Stories the shard is at least as up to date on are left alone: it might have newer versions
+# of them that haven't been merged yet.
+def seed(store, main, arguments):
+    for argument in arguments:
+        ncode = argument[0].rstrip("/").rsplit('/', 1)[-1]
+        if main.c.execute("SELECT 1 from novels where ncode=?", (ncode,)).fetchone() == None:
+            continue
+        theirs = (main.c.execute("SELECT datetime from ranks where ncode=?", (ncode,)).fetchone() or (None,))[0]
+        ours = (store.c.execute("SELECT datetime from ranks where ncode=?", (ncode,)).fetchone() or (None,))[0]
+        if ours != None and (theirs == None or theirs <= ours):
+            continue
+        store.merge_story(main, ncode)
+        store.database.commit()
+
+# [(state, worker, number of stories), ...]
+def status(coordination):
+    return coordination.execute("SELECT state, coalesce(worker, last_worker), count(*) from stories group by state, coalesce(worker, last_worker) order by state").fetchall()
+
+# Rips leased stories into the ripper's database until there are none left to lease. Stories other workers hold might still come free
+# (if those workers died), so this only stops once nothing is pending or leased anymore. main is the main database's Store, if the worker can reach it.
+async def work(ripper, coordination, worker, main=None):
+    settings = ripper.settings
+    
+    async def keep_renewing():
+        while True:
+            await asyncio.sleep(settings.lease_seconds / 3)
+            renew(coordination, worker, settings.lease_seconds)
+    
+    while True:
+        arguments = lease(coordination, worker, settings.lease_batch_size, settings.lease_seconds)
+        if len(arguments) == 0:
+            busy = coordination.execute("SELECT count(*) from stories where state='leased'").fetchone()[0]
+            if busy == 0:
+                print("nothing left to rip")
+                return
+            print(f"waiting for {busy} stories other workers are ripping")
+            await asyncio.sleep(min(settings.lease_seconds, 60))
+            continue
+        
+        print(f"leased {len(arguments)} stories")
+        if main != None:
+            seed(ripper.store, main, arguments)
+        # sync only stores the rank of stories it rips, and stories that are up to date get skipped. Store.merge_story carries the shard's ranks over.
+        ripper.update_ranks([argument for argument in arguments if argument[1] != None and int(argument[1]) >= 1])
+        ripper.store.commit()
+        renewer = asyncio.create_task(keep_renewing())
+        dead = len(ripper.dead)
+        try:
+            await ripper.sync(arguments)
+        finally:
+            renewer.cancel()
+        finish(coordination, worker, arguments, set(ripper.dead[dead:]))
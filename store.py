@@ -0,0 +1,549 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# The database: its layout (and the migrations that get older databases there), compression of stored chapters, the search index,
+# and the queries that read from it. Store wraps an open sqlite3 connection; open_database opens one the way rip.py does.
+
+import sqlite3
+import json
+import os
+import time
+from functools import partial
+import codec
+from extract import stored_text_and_count, stored_to_text, content_hash
+from parsepool import ParsePool
+
+# Every change to the layout of the database is a migration. PRAGMA user_version says how many of them a database has had.
+# Databases from before this existed are version 0, and already have most of what migration 1 creates.
+
+def migration_1(c):
+    c.execute("CREATE table if not exists narou (ncode text, title text, chapcode text, chapter int, chaptitle text, datetime text, content text)")
+    c.execute("CREATE unique index if not exists idx_chapcode on narou (chapcode)")
+    
+    c.execute("CREATE table if not exists ranks (ncode text, rank text, datetime text)")
+    c.execute("CREATE unique index if not exists idx_ncode on ranks (ncode)")
+    
+    c.execute("CREATE table if not exists volumes (ncode text, title text, volcode text, volume int, chapters text)")
+    c.execute("CREATE unique index if not exists idx_volcode on volumes (volcode)")
+    
+    c.execute("CREATE table if not exists summaries (ncode text, summary text)")
+    c.execute("CREATE unique index if not exists idx_summary_ncode on summaries (ncode)")
+    
+    # everything novelapi knows about each story, as of the last time we asked
+    c.execute("CREATE table if not exists novel_meta (ncode text, title text, writer text, general_all_no int, length int, novel_end int, novel_type int, general_firstup text, general_lastup text, novelupdated_at text, updated_at text, synced text, info text)")
+    c.execute("CREATE unique index if not exists idx_novel_meta_ncode on novel_meta (ncode)")
+    
+    c.execute("CREATE table if not exists state (key text, value text)")
+    c.execute("CREATE unique index if not exists idx_state_key on state (key)")
+    
+    # plain text and length of each chapter, so reading and counting doesn't have to parse the stored html every time
+    columns = [column[1] for column in c.execute("PRAGMA table_info(narou)").fetchall()]
+    if "text" not in columns:
+        c.execute("ALTER table narou add column text text")
+    if "charcount" not in columns:
+        c.execute("ALTER table narou add column charcount int")
+    
+    c.execute("CREATE table if not exists novel_stats (ncode text, chapters int, charcount int)")
+    c.execute("CREATE unique index if not exists idx_novel_stats_ncode on novel_stats (ncode)")
+
+# Splits narou up into novels and chapters (so the title isn't repeated on every chapter, and chapters can be looked up by story),
+# and stores the chapters of each volume as rows instead of a newline-separated string.
+def migration_2(c):
+    count = c.execute("SELECT count(*) from narou").fetchone()[0]
+    if count > 0:
+        print(f"moving {count} chapters to the new database layout (only happens once, and can take a while for large databases)")
+    
+    c.execute("CREATE table novels (ncode text primary key, title text)")
+    c.execute("INSERT into novels SELECT ncode, title from (SELECT ncode, title, max(chapter) from narou group by ncode)")
+    
+    c.execute("CREATE table chapters (ncode text, chapter int, chaptitle text, datetime text, content text, text text, charcount int)")
+    c.execute("INSERT into chapters SELECT ncode, chapter, chaptitle, datetime, content, text, charcount from narou order by ncode, chapter")
+    c.execute("CREATE unique index idx_chapters_ncode_chapter on chapters (ncode, chapter)")
+    c.execute("DROP table narou")
+    
+    c.execute("ALTER table volumes rename to volumes_old")
+    c.execute("CREATE table volumes (ncode text, volume int, title text)")
+    c.execute("CREATE unique index idx_volumes_ncode_volume on volumes (ncode, volume)")
+    c.execute("CREATE table volume_chapters (ncode text, volume int, position int, chapter int)")
+    c.execute("CREATE unique index idx_volume_chapters on volume_chapters (ncode, volume, position)")
+    for (ncode, volume, title, chapters) in c.execute("SELECT ncode, volume, title, chapters from volumes_old").fetchall():
+        c.execute("INSERT or replace into volumes values (?,?,?)", (ncode, volume, title))
+        c.executemany("INSERT or replace into volume_chapters values (?,?,?,?)", [(ncode, volume, position, int(chapter)) for (position, chapter) in enumerate(chapters.split("\n")) if chapter != ""])
+    c.execute("DROP table volumes_old")
+    
+    # used when moving a rank from one story to another
+    c.execute("CREATE index idx_ranks_rank on ranks (rank)")
+
+# zstd dictionaries that stored chapters were compressed with
+def migration_3(c):
+    c.execute("CREATE table compression_dicts (id integer primary key, method text, data blob, created text)")
+
+# What each ripping run planned to do and how far it got, so an interrupted run can be picked back up with --resume.
+def migration_4(c):
+    c.execute("CREATE table jobs (id integer primary key, state text, goodranks int, delta_discovery int, started int, ended int)")
+    c.execute("CREATE table job_stories (job int, ncode text, mainurl text, rank, state text, title text, novel_datetime text)")
+    c.execute("CREATE index idx_job_stories on job_stories (job, ncode)")
+    c.execute("CREATE table job_chapters (job int, ncode text, url text, chaptitle text, datetime text, done int)")
+    c.execute("CREATE index idx_job_chapters_ncode on job_chapters (job, ncode)")
+    c.execute("CREATE index idx_job_chapters_url on job_chapters (job, url)")
+
+# The parsed index page of each story, along with what's needed to ask narou whether it changed (ETag and Last-Modified headers)
+def migration_5(c):
+    c.execute("CREATE table index_cache (ncode text primary key, etag text, last_modified text, title text, rows text, fetched int)")
+
+# A hash of each chapter's content, so exports can tell which chapters changed without reading them.
+# The index covers everything needed for that, so it doesn't have to touch the (big) rows themselves.
+def migration_6(c):
+    c.execute("ALTER table chapters add column hash text")
+    c.execute("CREATE index idx_chapters_hash on chapters (ncode, chapter, hash)")
+    c.execute("CREATE table dump_manifest (ncode text primary key, path text, hash text, chapters int, written int)")
+
+# What each exported html file was made from, so exporting again only rewrites the files that would come out different.
+def migration_7(c):
+    c.execute("CREATE table export_manifest (path text primary key, ncode text, hash text, written int)")
+
+# Full-text search over the plain text of every chapter. The trigram tokenizer works for Japanese, which has no spaces between words.
+# The text itself isn't stored a second time: the index reads it (decompressed) from chapters through chapter_texts when it needs it, e.g. for snippets.
+# It gets filled in after the migrations, once everything has plain text.
+def migration_8(c):
+    c.execute("CREATE view chapter_texts as SELECT rowid, decode_content(text) as text, ncode, chapter from chapters")
+    c.execute("CREATE virtual table chapter_search using fts5(text, ncode unindexed, chapter unindexed, content='chapter_texts', content_rowid='rowid', tokenize='trigram')")
+
+# Every update time novelapi has told us about for each story, so --watch can tell how often a story updates.
+def migration_9(c):
+    c.execute("CREATE table novel_updates (ncode text, updated_at text)")
+    c.execute("CREATE unique index idx_novel_updates on novel_updates (ncode, updated_at)")
+    c.execute("INSERT or ignore into novel_updates SELECT ncode, novelupdated_at from novel_meta where novelupdated_at is not null")
+    c.execute("INSERT or ignore into novel_updates SELECT ncode, datetime from ranks where datetime is not null")
+
+# Earlier versions of chapters that got edited. Each is stored as a delta (see codec.make_delta) against the version that replaced it,
+# so getting one back means starting from the current version and applying the deltas of every revision after it, newest first.
+# datetime and hash are those of the earlier version; replaced is when we downloaded the version that replaced it.
+def migration_10(c):
+    c.execute("CREATE table chapter_history (ncode text, chapter int, revision int, datetime text, hash text, replaced int, delta blob)")
+    c.execute("CREATE unique index idx_chapter_history on chapter_history (ncode, chapter, revision)")
+
+# A snapshot of every ranking list each day it gets fetched, so ranks can be followed over time (ranks only has the current total_total rank).
+# Lists are stored by number instead of by name, and the table has no rowids, to keep it small.
+def migration_11(c):
+    c.execute("CREATE table rank_lists (id integer primary key, name text unique)")
+    c.execute("CREATE table rank_history (list int, date text, rank int, ncode text, primary key (list, date, rank)) without rowid")
+    c.execute("CREATE index idx_rank_history_ncode on rank_history (ncode, list, date)")
+
+migrations = [migration_1, migration_2, migration_3, migration_4, migration_5, migration_6, migration_7, migration_8, migration_9, migration_10, migration_11]
+
+def open_database(path):
+    return sqlite3.connect(path)
+
+class Store:
+    # Brings the database up to date (migrations, and filling in anything older versions didn't store) before returning.
+    def __init__(self, database, content_compression="none", parse_pool=None):
+        self.database = database
+        self.c = database.cursor()
+        # the file the database is in, for the parse workers, which open their own connections
+        self.path = database.execute("PRAGMA database_list").fetchone()[2]
+        self.parse_pool = parse_pool if parse_pool != None else ParsePool(0)
+        
+        if content_compression == "zstd" and codec.zstandard == None:
+            print("note: content_compression is set to zstd, but the zstandard module isn't installed. using zlib instead.")
+            content_compression = "zlib"
+        self.content_compression = content_compression
+        self.compression_dicts = {}
+        self.compression_dict = None
+        
+        # content and text can be compressed, so they always have to be read through decode_content()
+        database.create_function("decode_content", 1, lambda value: codec.decode(value, self.compression_dicts), deterministic=True)
+        
+        # WAL lets the database be read while it's being written to, and makes frequent commits much cheaper
+        self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=NORMAL")
+        
+        self.migrate()
+        
+        self.compression_dicts.update(self.c.execute("SELECT id, data from compression_dicts").fetchall())
+        # the newest zstd dictionary is used for new chapters
+        if self.content_compression == "zstd":
+            self.compression_dict = self.c.execute("SELECT id, data from compression_dicts where method='zstd' order by id desc limit 1").fetchone()
+        
+        self.backfill()
+    
+    def migrate(self):
+        c = self.c
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for (i, migration) in enumerate(migrations):
+            if i+1 <= version:
+                continue
+            # each migration either happens completely or not at all
+            if self.database.in_transaction:
+                self.database.commit()
+            c.execute("BEGIN")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {i+1}")
+            self.database.commit()
+    
+    def backfill(self):
+        c = self.c
+        # chapters stored before the text/charcount columns existed need them filled in once
+        missing = c.execute("SELECT count(*) from chapters where text is null or charcount is null").fetchone()[0]
+        if missing > 0:
+            print(f"filling in plain text for {missing} chapters stored by an older version (only happens once)")
+            filled = 0
+            while True:
+                data = c.execute("SELECT rowid, decode_content(content) from chapters where text is null or charcount is null limit 1000").fetchall()
+                if len(data) == 0:
+                    break
+                results = self.parse_pool.map(stored_text_and_count, [entry[1] for entry in data])
+                c.executemany("UPDATE chapters set text=?, charcount=? where rowid=?", [(self.encode_content(text), charcount, entry[0]) for (entry, (text, charcount)) in zip(data, results)])
+                self.database.commit()
+                filled += len(data)
+                print(f"{filled}/{missing}")
+            c.execute("DELETE from novel_stats")
+            c.execute("INSERT into novel_stats SELECT ncode, count(*), sum(charcount) from chapters group by ncode")
+            self.database.commit()
+        
+        # same for content hashes
+        missing = c.execute("SELECT count(*) from chapters where hash is null").fetchone()[0]
+        if missing > 0:
+            print(f"hashing {missing} chapters stored by an older version (only happens once)")
+            filled = 0
+            last = -1
+            while True:
+                data = c.execute("SELECT rowid, decode_content(content) from chapters where rowid>? and hash is null order by rowid limit 1000", (last,)).fetchall()
+                if len(data) == 0:
+                    break
+                c.executemany("UPDATE chapters set hash=? where rowid=?", [(content_hash(entry[1]), entry[0]) for entry in data])
+                self.database.commit()
+                last = data[-1][0]
+                filled += len(data)
+                print(f"{filled}/{missing}")
+        
+        if self.get_state("search_index_built") == None:
+            count = c.execute("SELECT count(*) from chapters").fetchone()[0]
+            if count > 0:
+                print(f"building the search index for {count} chapters (only happens once)")
+            c.execute("INSERT into chapter_search(chapter_search) values ('rebuild')")
+            self.set_state("search_index_built", "1")
+            self.database.commit()
+    
+    def commit(self):
+        self.database.commit()
+    
+    def encode_content(self, text):
+        return codec.encode(text, self.content_compression, self.compression_dict)
+    
+    def get_state(self, key, default=None):
+        value = self.c.execute("SELECT value from state where key=?", (key,)).fetchone()
+        if value == None:
+            return default
+        return value[0]
+    
+    def set_state(self, key, value):
+        self.c.execute("INSERT or replace into state values (?,?)", (key, value))
+    
+    def update_novel_stats(self, ncodes):
+        for ncode in ncodes:
+            self.c.execute("INSERT or replace into novel_stats SELECT ncode, count(*), sum(charcount) from chapters where ncode=? group by ncode", (ncode,))
+    
+    # Changes whenever any chapter of the story is added, removed, or changed. Returns (hash, number of chapters).
+    def story_fingerprint(self, ncode):
+        data = self.c.execute("SELECT chapter, hash from chapters where ncode=? order by chapter", (ncode,)).fetchall()
+        return (content_hash("\n".join(f"{chapter}:{hash}" for (chapter, hash) in data)), len(data))
+    
+    def has_volumes(self, ncode):
+        return self.c.execute("SELECT count(*) from volumes where ncode=?", (ncode,)).fetchone()[0] > 0
+    
+    # Returns [(volume title, [(chapter number, chapter title, hash), ...]), ...] in order, without loading any chapter contents.
+    # Stories without volume information come back as a single untitled volume with every chapter in it.
+    def get_story_layout(self, ncode):
+        c = self.c
+        volumes = c.execute("SELECT volume, title from volumes where ncode=? order by volume", (ncode,)).fetchall()
+        if len(volumes) == 0:
+            return [("", c.execute("SELECT chapter, chaptitle, hash from chapters where ncode=? order by chapter", (ncode,)).fetchall())]
+        layout = {volume: (title, []) for (volume, title) in volumes}
+        data = c.execute("SELECT volume_chapters.volume, volume_chapters.chapter, chapters.chaptitle, chapters.hash from volume_chapters left join chapters on chapters.ncode=volume_chapters.ncode and chapters.chapter=volume_chapters.chapter where volume_chapters.ncode=? order by volume_chapters.volume, volume_chapters.position", (ncode,)).fetchall()
+        for (volume, chapter, chaptitle, hash) in data:
+            if hash == None:
+                print(f"failed to find chapter {chapter} of story {ncode}")
+                continue
+            layout[volume][1].append((chapter, chaptitle, hash))
+        return [layout[volume] for (volume, title) in volumes]
+    
+    # Yields (chapter number, content) for the given chapters, in the same order as get_story_layout lists them, all from one query.
+    def stream_contents(self, ncode, chapters):
+        wanted = json.dumps(sorted(set(chapters)))
+        if self.has_volumes(ncode):
+            query = "SELECT volume_chapters.chapter, decode_content(chapters.content) from volume_chapters join chapters on chapters.ncode=volume_chapters.ncode and chapters.chapter=volume_chapters.chapter where volume_chapters.ncode=? and volume_chapters.chapter in (SELECT value from json_each(?)) order by volume_chapters.volume, volume_chapters.position"
+        else:
+            query = "SELECT chapter, decode_content(content) from chapters where ncode=? and chapter in (SELECT value from json_each(?)) order by chapter"
+        # its own cursor, since c gets used while this is being read from
+        for (chapter, content) in self.database.execute(query, (ncode, wanted)):
+            yield (chapter, content)
+    
+    # Exported files are only rewritten when something they're made from changes. dependencies is everything that goes into the file.
+    def export_is_current(self, path, dependencies):
+        if not os.path.exists(path):
+            return False
+        return self.c.execute("SELECT hash from export_manifest where path=?", (path,)).fetchone() == (content_hash(json.dumps(dependencies, ensure_ascii=False)),)
+    
+    def record_export(self, path, ncode, dependencies):
+        self.c.execute("INSERT or replace into export_manifest values (?,?,?,?)", (path, ncode, content_hash(json.dumps(dependencies, ensure_ascii=False)), int(time.time())))
+        self.database.commit()
+    
+    # entries are (ncode, chapter, datetime and hash of the version being replaced, delta)
+    def add_revisions(self, entries):
+        replaced = int(time.time())
+        for (ncode, chapter, datetime, hash, delta) in entries:
+            revision = self.c.execute("SELECT coalesce(max(revision), 0) + 1 from chapter_history where ncode=? and chapter=?", (ncode, chapter)).fetchone()[0]
+            self.c.execute("INSERT into chapter_history values (?,?,?,?,?,?,?)", (ncode, chapter, revision, datetime, hash, replaced, delta))
+    
+    # ranking is [[story url, rank], ...], as fetched on date. Fetching a list again on the same day replaces that day's snapshot.
+    def record_ranking(self, name, date, ranking):
+        self.c.execute("INSERT or ignore into rank_lists (name) values (?)", (name,))
+        list_id = self.c.execute("SELECT id from rank_lists where name=?", (name,)).fetchone()[0]
+        self.c.execute("DELETE from rank_history where list=? and date=?", (list_id, date))
+        self.c.executemany("INSERT or replace into rank_history values (?,?,?,?)", [(list_id, date, int(rank), url.rstrip("/").rsplit('/', 1)[-1]) for (url, rank) in ranking])
+    
+    # Has to happen before changing or deleting chapters, since the search index needs to know what text it's removing.
+    def unindex_chapters(self, keys):
+        for (ncode, chapter) in keys:
+            old = self.c.execute("SELECT rowid, text from chapter_texts where ncode=? and chapter=?", (ncode, chapter)).fetchone()
+            if old != None:
+                self.c.execute("INSERT into chapter_search(chapter_search, rowid, text, ncode, chapter) values ('delete',?,?,?,?)", (old[0], old[1], ncode, chapter))
+    
+    # entries are (ncode, chapter, plain text)
+    def index_chapters(self, entries):
+        for (ncode, chapter, text) in entries:
+            rowid = self.c.execute("SELECT rowid from chapters where ncode=? and chapter=?", (ncode, chapter)).fetchone()[0]
+            self.c.execute("INSERT into chapter_search(rowid, text, ncode, chapter) values (?,?,?,?)", (rowid, text, ncode, chapter))
+    
+    # Reading
+    
+    def known_ncodes(self):
+        return [ncode for (ncode,) in self.c.execute("SELECT ncode from novels").fetchall()]
+    
+    def titles(self):
+        return self.c.execute("SELECT ncode, title from novels").fetchall()
+    
+    def ranklist(self):
+        return self.c.execute("SELECT ncode, rank from ranks").fetchall()
+    
+    def title(self, ncode):
+        return self.c.execute("SELECT title from novels where ncode=?", (ncode,)).fetchone()[0]
+    
+    def summary(self, ncode):
+        summary = self.c.execute("SELECT summary from summaries where ncode=?", (ncode,)).fetchone()
+        if summary == None:
+            return None
+        return summary[0]
+    
+    def writer(self, ncode):
+        writer = self.c.execute("SELECT writer from novel_meta where ncode=?", (ncode,)).fetchone()
+        if writer == None:
+            return None
+        return writer[0]
+    
+    # [(chapter title, plain text), ...]
+    def story_text(self, ncode):
+        return self.c.execute("SELECT chaptitle, decode_content(text) from chapters where ncode=? order by chapter", (ncode,)).fetchall()
+    
+    # [(chapter number, chapter title), ...]
+    def chapter_list(self, ncode):
+        return self.c.execute("SELECT chapter, chaptitle from chapters where ncode=? order by chapter", (ncode,)).fetchall()
+    
+    # Length of the story, of one chapter (None if there's no such chapter), or of a range of chapters (inclusive)
+    def charcount(self, ncode, first=None, last=None):
+        if first == None:
+            data = self.c.execute("SELECT charcount from novel_stats where ncode=?", (ncode,)).fetchone()
+            return data[0] if data != None else 0
+        if last == None:
+            data = self.c.execute("SELECT charcount from chapters where ncode=? and chapter=?", (ncode, first)).fetchone()
+            return data[0] if data != None else None
+        return int(self.c.execute("SELECT total(charcount) from chapters where ncode=? and chapter>=? and chapter<=?", (ncode, first, last)).fetchone()[0])
+    
+    # [(ncode, characters, chapters, title), ...], longest first
+    def charcounts(self):
+        return self.c.execute("SELECT novel_stats.ncode, novel_stats.charcount, novel_stats.chapters, novels.title from novel_stats left join novels on novels.ncode=novel_stats.ncode order by novel_stats.charcount desc").fetchall()
+    
+    # [(ncode, chapter, snippet), ...]. query has to be at least 3 characters long.
+    def search(self, query, story=None, toprank=None, limit=50):
+        sql = "SELECT chapter_search.ncode, chapter_search.chapter, snippet(chapter_search, 0, '[', ']', '…', 24) from chapter_search"
+        conditions = ["chapter_search match ?"]
+        # as a phrase, so nothing in it gets treated as fts5 syntax
+        parameters = ['"' + query.replace('"', '""') + '"']
+        if toprank != None:
+            sql += " join ranks on ranks.ncode=chapter_search.ncode"
+            conditions += ["cast(ranks.rank as integer) between 1 and ?"]
+            parameters += [int(toprank)]
+        if story != None:
+            conditions += ["chapter_search.ncode=?"]
+            parameters += [story]
+        sql += " where " + " and ".join(conditions) + " order by chapter_search.rank limit ?"
+        parameters += [int(limit)]
+        return self.c.execute(sql, parameters).fetchall()
+    
+    # [(ncode, whether it's completed, when novelapi was last asked about it), ...] for every known story
+    def watch_list(self):
+        # novelapi's "end" is 0 for completed stories (and short stories, which can't get new chapters either)
+        return self.c.execute("SELECT novels.ncode, novel_meta.novel_end=0, novel_meta.synced from novels left join novel_meta on novel_meta.ncode=novels.ncode").fetchall()
+    
+    # The most recent times the story was updated, newest first, as "YYYY-MM-DD HH:MM:SS" (japan time):
+    # when novelapi said it was updated, and when each of its stored chapters was posted (or last edited).
+    def update_history(self, ncode, limit=20):
+        data = self.c.execute("SELECT updated_at from novel_updates where ncode=? union SELECT replace(datetime, '/', '-') || ':00' from chapters where ncode=? and datetime is not null order by 1 desc limit ?", (ncode, ncode, limit)).fetchall()
+        return [updated_at for (updated_at,) in data]
+    
+    # [(revision, datetime, replaced), ...] for the earlier versions of a chapter, oldest first
+    def chapter_history(self, ncode, chapter):
+        return self.c.execute("SELECT revision, datetime, replaced from chapter_history where ncode=? and chapter=? order by revision", (ncode, chapter)).fetchall()
+    
+    # Plain text of an earlier version of a chapter, or None if there's no such revision
+    def chapter_revision(self, ncode, chapter, revision):
+        current = self.c.execute("SELECT decode_content(content) from chapters where ncode=? and chapter=?", (ncode, chapter)).fetchone()
+        deltas = self.c.execute("SELECT revision, decode_content(delta) from chapter_history where ncode=? and chapter=? and revision>=? order by revision desc", (ncode, chapter, revision)).fetchall()
+        if current == None or len(deltas) == 0 or deltas[-1][0] != revision:
+            return None
+        content = current[0]
+        for (later, delta) in deltas:
+            content = codec.apply_delta(content, delta)
+        return stored_to_text(content)
+    
+    # [(list name, date, rank), ...] for every day the story was on a ranking list we fetched
+    def rank_history(self, ncode, name=None):
+        sql = "SELECT rank_lists.name, rank_history.date, rank_history.rank from rank_history join rank_lists on rank_lists.id=rank_history.list where rank_history.ncode=?"
+        parameters = [ncode]
+        if name != None:
+            sql += " and rank_lists.name=?"
+            parameters += [name]
+        return self.c.execute(sql + " order by rank_lists.name, rank_history.date", parameters).fetchall()
+    
+    # [(ncode, rank, title), ...]
+    def names(self):
+        return self.c.execute("SELECT novels.ncode, ranks.rank, novels.title from novels left join ranks on ranks.ncode=novels.ncode").fetchall()
+    
+    # Maintenance
+    
+    # Recompresses every stored chapter with the current compression method (training a new zstd dictionary first), then shrinks the database file.
+    def recompress(self, zstd_dictionary_size):
+        c = self.c
+        if self.content_compression == "zstd":
+            samples = c.execute("SELECT decode_content(content) from chapters where rowid in (SELECT rowid from chapters order by random() limit 2000)").fetchall()
+            print(f"training a compression dictionary on {len(samples)} chapters")
+            try:
+                data = codec.train_dictionary([sample[0] for sample in samples], zstd_dictionary_size)
+                c.execute("INSERT into compression_dicts (method, data, created) values (?,?,?)", ("zstd", data, time.strftime("%Y-%m-%d %H:%M:%S")))
+                self.compression_dict = (c.lastrowid, data)
+                self.compression_dicts[c.lastrowid] = data
+                self.database.commit()
+            except codec.zstandard.ZstdError as error:
+                print(f"couldn't train a dictionary ({error}), probably because there aren't enough chapters yet. compressing without one")
+        
+        target = c.execute("SELECT count(*) from chapters").fetchone()[0]
+        done = 0
+        last = -1
+        while True:
+            data = c.execute("SELECT rowid, decode_content(content), decode_content(text) from chapters where rowid>? order by rowid limit 1000", (last,)).fetchall()
+            if len(data) == 0:
+                break
+            results = self.parse_pool.map(partial(codec.encode_pair, method=self.content_compression, dictionary=self.compression_dict), [(entry[1], entry[2]) for entry in data])
+            c.executemany("UPDATE chapters set content=?, text=? where rowid=?", [(content, text, entry[0]) for (entry, (content, text)) in zip(data, results)])
+            self.database.commit()
+            last = data[-1][0]
+            done += len(data)
+            print(f"{done}/{target}")
+        
+        # so are the deltas of earlier versions of chapters
+        last = -1
+        while True:
+            data = c.execute("SELECT rowid, decode_content(delta) from chapter_history where rowid>? order by rowid limit 1000", (last,)).fetchall()
+            if len(data) == 0:
+                break
+            c.executemany("UPDATE chapter_history set delta=? where rowid=?", [(self.encode_content(entry[1]), entry[0]) for entry in data])
+            self.database.commit()
+            last = data[-1][0]
+        
+        # nothing uses the older dictionaries anymore
+        if self.compression_dict == None:
+            c.execute("DELETE from compression_dicts")
+        else:
+            c.execute("DELETE from compression_dicts where id!=?", (self.compression_dict[0],))
+        self.database.commit()
+        
+        print("shrinking the database file")
+        c.execute("VACUUM")
+    
+    # Copies every story in shard (another Store, e.g. a --shardwork worker's shard) into this database, replacing what's stored for them.
+    def merge(self, shard):
+        ncodes = shard.known_ncodes()
+        for (i, ncode) in enumerate(ncodes):
+            self.merge_story(shard, ncode)
+            self.database.commit()
+            print(f"{i+1}/{len(ncodes)} ({ncode})")
+    
+    def merge_story(self, shard, ncode):
+        c = self.c
+        s = shard.c
+        c.execute("INSERT into novels values (?,?) on conflict(ncode) do update set title=excluded.title", s.execute("SELECT ncode, title from novels where ncode=?", (ncode,)).fetchone())
+        for (table, columns) in [("novel_meta", 13), ("summaries", 2), ("index_cache", 6)]:
+            row = s.execute(f"SELECT * from {table} where ncode=?", (ncode,)).fetchone()
+            if row != None:
+                c.execute(f"INSERT or replace into {table} values ({','.join('?' * columns)})", row)
+        c.executemany("INSERT or ignore into novel_updates values (?,?)", s.execute("SELECT ncode, updated_at from novel_updates where ncode=?", (ncode,)).fetchall())
+        
+        # the shard's rank wins if it has one. its datetime always does: if the shard didn't finish the story, it has none, so the story gets checked again next time.
+        (rank, datetime) = s.execute("SELECT rank, datetime from ranks where ncode=?", (ncode,)).fetchone() or (None, None)
+        if rank != None:
+            c.execute("UPDATE ranks set rank=null where rank=? and ncode!=?", (rank, ncode))
+        else:
+            rank = (c.execute("SELECT rank from ranks where ncode=?", (ncode,)).fetchone() or (None,))[0]
+        c.execute("INSERT or replace into ranks values (?,?,?)", (ncode, rank, datetime))
+        
+        c.execute("DELETE from volumes where ncode=?", (ncode,))
+        c.execute("DELETE from volume_chapters where ncode=?", (ncode,))
+        c.executemany("INSERT into volumes values (?,?,?)", s.execute("SELECT ncode, volume, title from volumes where ncode=?", (ncode,)).fetchall())
+        c.executemany("INSERT into volume_chapters values (?,?,?,?)", s.execute("SELECT ncode, volume, position, chapter from volume_chapters where ncode=?", (ncode,)).fetchall())
+        
+        # chapters are compressed differently in each database (other dictionaries), so they get decoded and encoded again. one at a time, since they can be big.
+        for (chapter, chaptitle, datetime, content, text, charcount, hash) in shard.database.execute("SELECT chapter, chaptitle, datetime, decode_content(content), decode_content(text), charcount, hash from chapters where ncode=? order by chapter", (ncode,)):
+            stored = c.execute("SELECT hash from chapters where ncode=? and chapter=?", (ncode, chapter)).fetchone()
+            known = set(hash for (hash,) in c.execute("SELECT hash from chapter_history where ncode=? and chapter=?", (ncode, chapter)).fetchall())
+            if stored != None:
+                known.add(stored[0])
+            shard_history = set(hash for (hash,) in s.execute("SELECT hash from chapter_history where ncode=? and chapter=?", (ncode, chapter)).fetchall())
+            if stored != None and stored[0] == hash and shard_history <= known:
+                c.execute("UPDATE chapters set chaptitle=?, datetime=? where ncode=? and chapter=?", (chaptitle, datetime, ncode, chapter))
+                continue
+            if stored != None or len(shard_history) > 0:
+                self.merge_chapter_history(shard, ncode, chapter, content, hash)
+            self.unindex_chapters([(ncode, chapter)])
+            c.execute("INSERT or replace into chapters values (?,?,?,?,?,?,?,?)", (ncode, chapter, chaptitle, datetime, self.encode_content(content), self.encode_content(text), charcount, hash))
+            self.index_chapters([(ncode, chapter, text)])
+        self.update_novel_stats([ncode])
+    
+    # Every version of a chapter this database knows about, oldest first, as (datetime, hash, replaced, content). The current one is last.
+    def chapter_versions(self, ncode, chapter):
+        current = self.c.execute("SELECT datetime, hash, decode_content(content) from chapters where ncode=? and chapter=?", (ncode, chapter)).fetchone()
+        if current == None:
+            return []
+        versions = [(current[0], current[1], int(time.time()), current[2])]
+        for (datetime, hash, replaced, delta) in self.c.execute("SELECT datetime, hash, replaced, decode_content(delta) from chapter_history where ncode=? and chapter=? order by revision desc", (ncode, chapter)).fetchall():
+            versions.insert(0, (datetime, hash, replaced, codec.apply_delta(versions[0][3], delta)))
+        return versions
+    
+    # Puts the versions of a chapter from both databases in one history, in order of their dates, before the shard's current version (content).
+    def merge_chapter_history(self, shard, ncode, chapter, content, hash):
+        versions = []
+        seen = {hash}
+        for version in sorted(self.chapter_versions(ncode, chapter) + shard.chapter_versions(ncode, chapter)[:-1], key=lambda version: (version[0] or "", version[2])):
+            if version[1] not in seen:
+                seen.add(version[1])
+                versions += [version]
+        self.c.execute("DELETE from chapter_history where ncode=? and chapter=?", (ncode, chapter))
+        newer = [version[3] for version in versions[1:]] + [content]
+        self.c.executemany("INSERT into chapter_history values (?,?,?,?,?,?,?)", [(ncode, chapter, i+1, datetime, hash, replaced, self.encode_content(codec.make_delta(newer[i], older))) for (i, (datetime, hash, replaced, older)) in enumerate(versions)])
+    
+    # for debugging/repair only
+    def delete_datetime_data(self):
+        self.c.execute("UPDATE ranks set datetime=null")
+        self.c.execute("UPDATE chapters set datetime=null")
+        self.database.commit()
@@ -0,0 +1,148 @@
+#!python
+
+# Licensed under the Apache License, Version 2.0.
+
+# Keeps running and checks every known story for updates on its own schedule, instead of checking all of them at once like --updateknown.
+# How often a story gets checked depends on how often it has updated before (see check_interval), so stories that update every day
+# get their new chapters soon after they're posted, and stories that haven't changed in years barely cost anything.
+# Stories that are due get checked together, up to novelapi_batch_size at a time, so checking many stories still only takes a few requests.
+
+import asyncio
+import calendar
+import collections
+import heapq
+import time
+
+# narou's times are japan time. Returns a unix time, or None if the string isn't a time.
+def narou_time(string):
+    for format in ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M"):
+        try:
+            return calendar.timegm(time.strptime(string, format)) - 9*60*60
+        except ValueError:
+            continue
+    return None
+
+# How many seconds to wait before checking a story again. updates are unix times the story was updated at, oldest first.
+def check_interval(settings, updates, completed, now):
+    if completed:
+        return settings.watch_completed_interval
+    if len(updates) == 0:
+        return settings.watch_min_interval
+    # the median is used so that a few edits in a row (or one long break) don't throw it off
+    expected = now - updates[-1]
+    if len(updates) >= 2:
+        gaps = sorted(b - a for (a, b) in zip(updates, updates[1:]))
+        expected = max(expected, gaps[len(gaps)//2])
+    interval = expected / settings.watch_checks_per_update
+    return min(max(interval, settings.watch_min_interval), settings.watch_max_interval)
+
+# At most per_hour requests in any hour: every request waits until fewer than that were made in the last hour.
+class RequestBudget:
+    def __init__(self, per_hour, metrics):
+        self.per_hour = per_hour
+        self.metrics = metrics
+        # when each request in the last hour was made
+        self.made = collections.deque()
+    
+    # seconds until there's room for another request
+    def wait(self, now):
+        while len(self.made) > 0 and self.made[0] <= now - 60*60:
+            self.made.popleft()
+        if len(self.made) < self.per_hour:
+            return 0
+        return self.made[0] + 60*60 - now
+    
+    async def acquire(self):
+        while True:
+            now = time.time()
+            wait = self.wait(now)
+            if wait == 0:
+                self.made.append(now)
+                return
+            with self.metrics.timed("budget_sleep"):
+                await asyncio.sleep(wait)
+
+class Watcher:
+    # on_checked is called (without arguments) after every round of checks, e.g. to write out metrics
+    def __init__(self, ripper, on_checked=None):
+        self.ripper = ripper
+        self.store = ripper.store
+        self.settings = ripper.settings
+        self.on_checked = on_checked
+        # (when, ncode). stories that got rescheduled leave their old entry behind, so entries that don't match due are skipped.
+        self.queue = []
+        self.due = {}
+        # every request the ripper makes counts, not just checks, so a round with many new chapters waits partway instead of going over
+        self.budget = RequestBudget(self.settings.watch_requests_per_hour, ripper.metrics)
+    
+    def schedule(self, ncode, completed, last_checked, now):
+        updates = sorted(set(narou_time(entry) for entry in self.store.update_history(ncode)) - {None})
+        when = max(last_checked + check_interval(self.settings, updates, completed, now), now)
+        self.due[ncode] = when
+        heapq.heappush(self.queue, (when, ncode))
+    
+    # Schedules known stories that aren't scheduled yet (all of them, the first time), e.g. ones another process ripped since.
+    def add_new_stories(self):
+        now = time.time()
+        for (ncode, completed, synced) in self.store.watch_list():
+            if ncode in self.due:
+                continue
+            last_checked = now - self.settings.watch_min_interval
+            if synced != None:
+                last_checked = time.mktime(time.strptime(synced, "%Y-%m-%d %H:%M:%S"))
+            self.schedule(ncode, completed == 1, last_checked, now)
+    
+    # Returns the stories that are due, or how long to wait until some are (or there's room in the request budget for them).
+    def take_due(self, now):
+        while len(self.queue) > 0 and self.due.get(self.queue[0][1]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+        if len(self.queue) == 0:
+            return (None, self.settings.watch_min_interval)
+        wait = max(self.queue[0][0] - now, self.budget.wait(now))
+        if wait > 0:
+            return (None, wait)
+        
+        due = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now + self.settings.watch_batch_ahead and len(due) < self.settings.novelapi_batch_size:
+            (when, ncode) = heapq.heappop(self.queue)
+            if self.due.get(ncode) == when:
+                del self.due[ncode]
+                due += [ncode]
+        return (due, 0)
+    
+    async def run(self):
+        ripper = self.ripper
+        ripper.controller.budget = self.budget
+        self.add_new_stories()
+        print(f"watching {len(self.due)} stories")
+        announced = None
+        while True:
+            (due, wait) = self.take_due(time.time())
+            if due == None:
+                if announced == None or abs(announced - (time.time() + wait)) > 1:
+                    announced = time.time() + wait
+                    print(f"next check in {round(wait)} seconds")
+                # wake up every so often to pick up stories that were added in the meantime
+                await asyncio.sleep(min(wait, self.settings.watch_min_interval))
+                self.add_new_stories()
+                continue
+            
+            print(f"checking {len(due)} stories")
+            dead = len(ripper.dead)
+            # -1 leaves their ranks alone
+            await ripper.sync([[ncode, -1] for ncode in due])
+            now = time.time()
+            
+            gone = set(ripper.dead[dead:])
+            for ncode in gone:
+                print(f"{ncode} no longer exists on narou, not checking it anymore")
+            completed = {ncode: completed == 1 for (ncode, completed, synced) in self.store.watch_list()}
+            for ncode in due:
+                if ncode not in gone:
+                    self.schedule(ncode, completed.get(ncode, False), now, now)
+                else:
+                    # so add_new_stories doesn't pick it back up
+                    self.due[ncode] = None
+            
+            if self.on_checked != None:
+                self.on_checked()
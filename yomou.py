@@ -6,10 +6,30 @@ import urllib.request
 from urllib.parse import urljoin
 import sys
 
+# the periods yomou ranks stories over, and the genres it has lists for
+ranking_periods = ["daily", "weekly", "monthly", "quarter", "yearly", "total"]
+ranking_genres = ["101", "102", "201", "202", "301", "302", "303", "304", "305", "306", "307", "401", "402", "403", "404", "9901", "9902", "9903", "9904", "9999", "9801"]
+
+# name is what yomou calls the list in its urls: <period>_total (like total_total or daily_total), or <period>_<genre> for one genre, like daily_101
+def is_ranking_name(name):
+    (period, _, kind) = name.partition("_")
+    return period in ranking_periods and (kind == "total" or kind in ranking_genres)
+
+def ranking_url(name):
+    if not is_ranking_name(name):
+        raise ValueError(f"yomou has no ranking list called {name}")
+    if name.endswith("_total"):
+        return f"http://yomou.syosetu.com/rank/list/type/{name}/"
+    return f"http://yomou.syosetu.com/rank/genrelist/type/{name}/"
+
 def get_top_300(url):
     r = urllib.request.urlopen(url)
     data = r.read()
     r.close()
+    return parse_ranking(data)
+
+# data is the html of a ranking page
+def parse_ranking(data):
     soup = BeautifulSoup(data, "html.parser")
 
     novels = []